@@ -1,4 +1,10 @@
 from .relation_classfication import FlairRelationTrainer
 from .sequence_labeling import FlairSequenceLabelingTrainer
+from .triplet_extraction import Triplet, TripletExtractor
 
-__all__ = ["FlairRelationTrainer", "FlairSequenceLabelingTrainer"]
+__all__ = [
+    "FlairRelationTrainer",
+    "FlairSequenceLabelingTrainer",
+    "Triplet",
+    "TripletExtractor",
+]
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+CONFIG_PATH="./config.ini"
+DIALOGUES_PATH="please add this first!"
+OUTPUT_PATH="triplets.csv"
+
+# The dialogues file is a CSV with a call_id and a text column
+python -c "
+import csv
+from triplet_extraction import TripletExtractor
+
+extractor = TripletExtractor.from_config('$CONFIG_PATH')
+with open('$DIALOGUES_PATH', newline='', encoding='utf-8') as f:
+    reader = csv.reader(f)
+    next(reader)
+    extractor.extract_to_csv(((row[0], row[1]) for row in reader), '$OUTPUT_PATH')
+"
+
+echo "Triplet extraction complete, see $OUTPUT_PATH"
@@ -0,0 +1,248 @@
+import configparser
+import csv
+import logging
+import pickle
+import flair
+import numpy as np
+import torch
+from flair.data import Sentence
+from flair.models import RelationClassifier, SequenceTagger
+from flair.splitter import SegtokSentenceSplitter
+from itertools import islice
+from time import perf_counter
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+logging.basicConfig(filename="inference.log", encoding="utf-8", level=logging.DEBUG)
+
+
+class Triplet(NamedTuple):
+    call_id: str
+    subject: str
+    subject_type: str
+    relation: str
+    object: str
+    object_type: str
+    confidence: float
+    sentence: str
+    context_before: str
+    context_after: str
+
+
+class CandidateFilter:
+    """
+    Counts the relation candidates of a sentence: the ordered pairs of distinct entities whose (head type, tail type)
+    is one of the allowed entity pairs, the `entity_pair_labels` the `RelationClassifier` was trained with. The
+    classifier skips every other pair itself, so the count does not save forward passes on them; it decides which
+    sentences are sent to the classifier at all (those with a candidate) and how they are batched. Without allowed
+    pairs every pair is a candidate. Keeps count of the pairs it saw and of those with other types.
+    """
+
+    def __init__(self, entity_pair_labels: Optional[Set[Tuple[str, str]]] = None):
+        self.entity_pair_labels = entity_pair_labels
+        self.tails_by_head: Optional[Dict[str, Set[str]]] = None
+        if entity_pair_labels is not None:
+            self.tails_by_head = {}
+            for head_type, tail_type in entity_pair_labels:
+                self.tails_by_head.setdefault(head_type, set()).add(tail_type)
+        self.n_pairs = 0
+        self.n_pruned = 0
+
+    @classmethod
+    def from_pickle(cls, entity_label_map_path: str) -> "CandidateFilter":
+        with open(entity_label_map_path, "rb") as file:
+            return cls(set(pickle.load(file)))
+
+    def count_candidates(self, sentence: Sentence, label_type: str) -> int:
+        # one type per entity, like the pairs the RelationClassifier builds
+        types = [
+            span.get_label(label_type).value for span in sentence.get_spans(label_type)
+        ]
+        n_pairs = len(types) * (len(types) - 1)
+        if self.tails_by_head is None:
+            n_candidates = n_pairs
+        else:
+            n_candidates = sum(
+                1
+                for head, head_type in enumerate(types)
+                for tail, tail_type in enumerate(types)
+                if head != tail and tail_type in self.tails_by_head.get(head_type, ())
+            )
+        self.n_pairs += n_pairs
+        self.n_pruned += n_pairs - n_candidates
+        return n_candidates
+
+
+class TripletExtractor:
+    """
+    CPU inference with a trained `SequenceTagger` (NER) and `RelationClassifier`, turning dialogues into
+    subject/relation/object triplets. Dialogues are read `window` at a time and split into sentences. The sentences
+    of a window are sorted by length and cut into batches of batch_size, so every batch holds sentences of about the
+    same length (little padding), first for NER and then, for the sentences with at least two entities, for relations.
+    """
+
+    def __init__(
+        self,
+        ner_model_path: str,
+        relation_model_path: str,
+        batch_size: int = 32,
+        workers: int = 1,
+        window: int = 256,
+        entity_label_map_path: str = None,
+    ):
+        """
+        entity_label_map_path is the pickled set of allowed (head type, tail type) pairs used to count the relation
+        candidates, by default the `entity_pair_labels` stored in the relation model are used. The relation model
+        itself always keeps the pairs it was trained with.
+        """
+        flair.device = torch.device("cpu")
+        torch.set_num_threads(workers)
+        self.batch_size = batch_size
+        self.window = window
+        self.tagger = SequenceTagger.load(ner_model_path)
+        self.relation_classifier = RelationClassifier.load(relation_model_path)
+        if entity_label_map_path:
+            self.candidate_filter = CandidateFilter.from_pickle(entity_label_map_path)
+            trained_pairs = self.relation_classifier.entity_pair_labels
+            if trained_pairs is not None and set(trained_pairs) != (
+                self.candidate_filter.entity_pair_labels
+            ):
+                logging.warning(
+                    f"The entity pairs in {entity_label_map_path} differ from the ones the relation model was "
+                    f"trained with, which still decide the pairs it classifies"
+                )
+        else:
+            self.candidate_filter = CandidateFilter(
+                self.relation_classifier.entity_pair_labels
+            )
+        self.splitter = SegtokSentenceSplitter()
+        # end-to-end time of every window and its number of dialogues, see `extract`
+        self.window_latencies: List[Tuple[float, int]] = []
+
+    @classmethod
+    def from_config(cls, config_path: str) -> "TripletExtractor":
+        config = configparser.ConfigParser()
+        config.read(config_path)
+        section = config["Inference"]
+        return cls(
+            section["ner_model_path"],
+            section["relation_model_path"],
+            batch_size=section.getint("batch_size", 32),
+            workers=section.getint("workers", 1),
+            window=section.getint("window", 256),
+            entity_label_map_path=section.get("entity_label_map_path"),
+        )
+
+    def extract(self, dialogues: Iterable[Tuple[str, str]]) -> Iterator[Triplet]:
+        """
+        Yields the triplets of every (call_id, text) dialogue, in the order of the dialogues.
+        """
+        t = perf_counter()
+        n_docs = n_sentences = n_triplets = 0
+        self.window_latencies = []
+        self.candidate_filter.n_pairs = self.candidate_filter.n_pruned = 0
+
+        iterator = iter(dialogues)
+        while window := list(islice(iterator, self.window)):
+            started = perf_counter()
+            split = [self.splitter.split(text or "") for _, text in window]
+            sentences = [sentence for doc in split for sentence in doc]
+            self._predict(sentences)
+
+            window_triplets = []
+            for (call_id, _), doc in zip(window, split):
+                for position in range(len(doc)):
+                    window_triplets.extend(
+                        self._sentence_triplets(call_id, doc, position)
+                    )
+            # Dialogues are predicted in batches per window, so no dialogue is done before its window. Timed before
+            # yielding, so the time the consumer holds the generator suspended is not counted.
+            self.window_latencies.append((perf_counter() - started, len(window)))
+            n_docs += len(window)
+            n_sentences += len(sentences)
+            n_triplets += len(window_triplets)
+            yield from window_triplets
+
+        elapsed = max(perf_counter() - t, 1e-9)
+        p95_window = p95_per_dialogue = 0.0
+        if self.window_latencies:
+            p95_window = float(
+                np.percentile([latency for latency, _ in self.window_latencies], 95)
+            )
+            p95_per_dialogue = float(
+                np.percentile([latency / n for latency, n in self.window_latencies], 95)
+            )
+        logging.info(
+            f"Extracted {n_triplets} triplets from {n_docs} dialogues ({n_sentences} sentences) in {elapsed:.1f}s: "
+            f"{n_docs / elapsed:.2f} docs/s, p95 window latency {p95_window * 1000:.0f} ms for windows of up to "
+            f"{self.window} dialogues ({p95_per_dialogue * 1000:.1f} ms per dialogue) "
+            f"(batch_size={self.batch_size}, workers={torch.get_num_threads()})"
+        )
+        logging.info(
+            f"{self.candidate_filter.n_pruned} of {self.candidate_filter.n_pairs} entity pairs were no relation "
+            f"candidates (not an allowed entity type pair), sentences without candidates were not sent to the "
+            f"relation model"
+        )
+
+    def extract_to_csv(
+        self, dialogues: Iterable[Tuple[str, str]], output_path: str
+    ) -> int:
+        n_triplets = 0
+        with open(output_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(Triplet._fields)
+            for triplet in self.extract(dialogues):
+                writer.writerow(triplet)
+                n_triplets += 1
+        return n_triplets
+
+    def _predict(self, sentences: List[Sentence]):
+        by_length = sorted(
+            (sentence for sentence in sentences if len(sentence)), key=len
+        )
+        for batch in _batches(by_length, self.batch_size):
+            self.tagger.predict(batch, mini_batch_size=self.batch_size)
+
+        # Batches hold about batch_size relation candidates, each candidate is one forward pass of the classifier.
+        batch, n_candidates = [], 0
+        for sentence in by_length:
+            sentence_candidates = self.candidate_filter.count_candidates(
+                sentence, self.tagger.tag_type
+            )
+            if not sentence_candidates:
+                continue
+            batch.append(sentence)
+            n_candidates += sentence_candidates
+            if n_candidates >= self.batch_size:
+                self.relation_classifier.predict(batch, mini_batch_size=self.batch_size)
+                batch, n_candidates = [], 0
+        if batch:
+            self.relation_classifier.predict(batch, mini_batch_size=self.batch_size)
+
+    def _sentence_triplets(
+        self, call_id: str, doc: List[Sentence], position: int
+    ) -> Iterator[Triplet]:
+        sentence = doc[position]
+        context_before = doc[position - 1].to_original_text() if position > 0 else ""
+        context_after = (
+            doc[position + 1].to_original_text() if position + 1 < len(doc) else ""
+        )
+        entity_type = self.tagger.tag_type
+        for label in sentence.get_labels(self.relation_classifier.label_type):
+            relation = label.data_point
+            yield Triplet(
+                call_id,
+                relation.first.text,
+                relation.first.get_label(entity_type).value,
+                label.value,
+                relation.second.text,
+                relation.second.get_label(entity_type).value,
+                round(label.score, 4),
+                sentence.to_original_text(),
+                context_before,
+                context_after,
+            )
+
+
+def _batches(items: List, batch_size: int) -> Iterator[List]:
+    for start in range(0, len(items), batch_size):
+        yield items[start : start + batch_size]
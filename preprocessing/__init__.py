@@ -1,6 +1,11 @@
 from .setup_labelbox import DataLabellingService
 from .utils import *
+from .doc_cache import DocCache
+from .graph_loader import DeltaGraphLoader
+from .span_finder import SpanFinder
+from .writers import Neo4jImportWriter
 from .entity_relation_extraction import (
+    DocumentExtraction,
     EntityRelationshipExtractor,
     export_training_data,
     generate_training_data,
@@ -8,7 +13,12 @@ from .entity_relation_extraction import (
 
 __all__ = [
     "DataLabellingService",
+    "DeltaGraphLoader",
+    "DocCache",
+    "DocumentExtraction",
     "EntityRelationshipExtractor",
     "export_training_data",
     "generate_training_data",
+    "Neo4jImportWriter",
+    "SpanFinder",
 ]
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from spacy.tokens import Doc, DocBin
+from spacy.vocab import Vocab
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+def cache_key(export_path: str, *mappings: Dict, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash of the raw export plus the mappings that shape the annotations, so any change to either invalidates the cache.
+    """
+    digest = hashlib.sha256()
+    with open(export_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    for mapping in mappings:
+        digest.update(json.dumps(mapping, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class DocCache:
+    """
+    Stores annotated docs as sharded spaCy `DocBin` files, one directory per cache key:
+        cache_dir/<key>/shard_00000.spacy, shard_00001.spacy, ..., manifest.json
+    User data is stored too, so the `doc._.rel` and `doc._.rel_ready` extensions survive the round trip.
+    The manifest is written last, a directory without one is treated as a miss.
+    """
+
+    def __init__(self, cache_dir: str, shard_size: int = 1000):
+        self.cache_dir = cache_dir
+        self.shard_size = shard_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self._path(key), "manifest.json")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._manifest_path(key))
+
+    def save(self, key: str, docs: List[Doc]):
+        tmp_path = self._path(key) + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        shards = []
+        for start in range(0, len(docs), self.shard_size):
+            shard = f"shard_{len(shards):05d}.spacy"
+            doc_bin = DocBin(
+                store_user_data=True, docs=docs[start : start + self.shard_size]
+            )
+            doc_bin.to_disk(os.path.join(tmp_path, shard))
+            shards.append(shard)
+
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump({"n_docs": len(docs), "shards": shards}, f)
+
+        shutil.rmtree(self._path(key), ignore_errors=True)
+        os.replace(tmp_path, self._path(key))
+        logging.info(f"Cached {len(docs)} docs in {len(shards)} shards under {key}")
+
+    def iter_docs(self, key: str, vocab: Vocab) -> Iterator[Doc]:
+        with open(self._manifest_path(key)) as f:
+            manifest = json.load(f)
+        for shard in manifest["shards"]:
+            doc_bin = DocBin().from_disk(os.path.join(self._path(key), shard))
+            yield from doc_bin.get_docs(vocab)
+
+    def load(self, key: str, vocab: Vocab) -> Optional[List[Doc]]:
+        if not self.exists(key):
+            return None
+        docs = list(self.iter_docs(key, vocab))
+        logging.info(f"Loaded {len(docs)} docs from the cache under {key}")
+        return docs
+
+
+def mapping_digest(*mappings: Dict) -> str:
+    digest = hashlib.sha256()
+    for mapping in mappings:
+        digest.update(json.dumps(mapping, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def item_hash(item: Dict, mappings: str) -> str:
+    """
+    Hash of everything that shapes the extraction of a Labelbox item: its text, its labels and the mapping versions
+    (a `mapping_digest`).
+    """
+    digest = hashlib.sha256()
+    digest.update(mappings.encode("utf-8"))
+    digest.update(
+        json.dumps(
+            [item["Labeled Data"], item["Label"]], sort_keys=True, default=str
+        ).encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+class ItemCache:
+    """
+    Per item cache of `extract_ent_rel_pairs`, for exports that mostly contain the items of the previous one:
+        cache_dir/manifest.json   {"mappings": <mapping digest>, "items": {item ID: item hash}}
+        cache_dir/docs.spacy      the docs (with their `rel` extension), in the order of records.jsonl
+        cache_dir/records.jsonl   per item: ID, hash, entities, relations, entity location rows and relationship labels
+    The manifest alone tells which items changed, the docs are only read back for the ones that did not.
+    The whole directory is replaced on save, a cache written with other mappings is ignored.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def manifest(self, mappings: str) -> Dict[str, str]:
+        """
+        Item ID -> item hash of the cached items, empty when there is no cache for these mappings.
+        """
+        if not os.path.exists(self._path("manifest.json")):
+            return {}
+        with open(self._path("manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest["mappings"] != mappings:
+            logging.info("The mappings changed, ignoring the item cache")
+            return {}
+        return manifest["items"]
+
+    def load(self, ids: Set[str], vocab: Vocab) -> Dict[str, Tuple]:
+        """
+        (doc, entities, relations, entity location rows, relationship labels) of the cached items in ids.
+        """
+        if not ids:
+            return {}
+        entries = {}
+        doc_bin = DocBin().from_disk(self._path("docs.spacy"))
+        with open(self._path("records.jsonl"), encoding="utf-8") as f:
+            for line, doc in zip(f, doc_bin.get_docs(vocab)):
+                record = json.loads(line)
+                if record["id"] in ids:
+                    entries[record["id"]] = (
+                        doc,
+                        [tuple(entity) for entity in record["entities"]],
+                        [tuple(relation) for relation in record["relations"]],
+                        record["entity_rows"],
+                        set(record["rel_labels"]),
+                    )
+        return entries
+
+    def save(self, mappings: str, entries: Iterable[Tuple]):
+        """
+        entries: (ID, hash, doc, entities, relations, entity location rows, relationship labels) per item.
+        """
+        tmp_dir = self.cache_dir.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        items = {}
+        doc_bin = DocBin(store_user_data=True)
+        with open(os.path.join(tmp_dir, "records.jsonl"), "w", encoding="utf-8") as f:
+            for (
+                item_id,
+                item_digest,
+                doc,
+                entities,
+                relations,
+                entity_rows,
+                rel_labels,
+            ) in entries:
+                if item_id in items:
+                    continue
+                items[item_id] = item_digest
+                doc_bin.add(doc)
+                record = {
+                    "id": item_id,
+                    "hash": item_digest,
+                    "entities": entities,
+                    "relations": relations,
+                    "entity_rows": entity_rows,
+                    "rel_labels": sorted(rel_labels),
+                }
+                f.write(json.dumps(record, default=str) + "\n")
+        doc_bin.to_disk(os.path.join(tmp_dir, "docs.spacy"))
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump({"mappings": mappings, "items": items}, f)
+
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.cache_dir)
+        logging.info(f"Cached {len(items)} items in {self.cache_dir}")
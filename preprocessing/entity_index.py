@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+class EntityIndex:
+    """
+    Array-backed lookup table for the entity spans written by `extract_ent_rel_pairs`.
+    Built once (id -> row), then every lookup is a dict hit plus an array read instead of a full DataFrame scan.
+    """
+
+    def __init__(
+        self,
+        ids: Sequence[str],
+        starts: Sequence[int],
+        ends: Sequence[int],
+        types: Sequence[str],
+    ):
+        if not (len(ids) == len(starts) == len(ends) == len(types)):
+            raise ValueError("ids, starts, ends and types must have the same length")
+
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+        # Entity types are repeated a lot, so we store them as small integer codes.
+        self.type_names, type_codes = np.unique(
+            np.asarray(types, dtype=object).astype(str), return_inverse=True
+        )
+        self.type_codes = type_codes.astype(np.int32)
+
+        # Keep the first occurrence of an id, the same row `df[df["id"] == ent_id]` used to return.
+        self._positions: Dict[str, int] = {}
+        for position, ent_id in enumerate(ids):
+            self._positions.setdefault(ent_id, position)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Sequence]) -> "EntityIndex":
+        """
+        Rows as written to the entity locations file: [id, start, end, type, text].
+        """
+        ids, starts, ends, types = [], [], [], []
+        for row in rows:
+            ids.append(row[0])
+            starts.append(int(row[1]))
+            ends.append(int(row[2]))
+            types.append(row[3])
+        return cls(ids, starts, ends, types)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "EntityIndex":
+        return cls(
+            df["id"].tolist(), df["start"].values, df["end"].values, df["type"].tolist()
+        )
+
+    @classmethod
+    def from_csv(cls, file_path: str) -> "EntityIndex":
+        df = pd.read_csv(
+            file_path,
+            header=None,
+            names=["id", "start", "end", "type", "text"],
+            dtype={"id": str, "type": str, "text": str},
+            keep_default_na=False,
+        )
+        return cls.from_dataframe(df)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, ent_id: str) -> bool:
+        return ent_id in self._positions
+
+    def lookup(self, ent_id: str) -> Tuple[int, int, str]:
+        position = self._positions.get(ent_id)
+        if position is None:
+            raise KeyError(f"Unknown entity id: {ent_id}")
+        return (
+            int(self.starts[position]),
+            int(self.ends[position]),
+            str(self.type_names[self.type_codes[position]]),
+        )
+
+    def lookup_many(
+        self, ent_ids: Sequence[str]
+    ) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """
+        Batch version of `lookup`. Returns the starts and ends as arrays (aligned with `ent_ids`) and the types as a list.
+        """
+        positions = np.fromiter(
+            (self._positions[ent_id] for ent_id in ent_ids),
+            dtype=np.int64,
+            count=len(ent_ids),
+        )
+        types = self.type_names[self.type_codes[positions]].tolist()
+        return self.starts[positions], self.ends[positions], types
@@ -6,14 +6,57 @@ import os
 import random
 import pandas as pd
 import datetime
-from spacy.tokens import Doc, Span
-from spacy.training import iob_to_biluo
-from typing import Dict, List, Tuple
-from itertools import combinations
+from spacy.tokens import Doc, DocBin, Span
+from spacy.vocab import Vocab
+from typing import Dict, Iterable, List, Tuple, Union
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from time import time
+
+from .doc_cache import DocCache, ItemCache, cache_key, item_hash, mapping_digest
+from .entity_index import EntityIndex
+from .tagging import iter_bioes_tagged
+from .utils import iter_json
+from .writers import ExtractionSink
 
 logging.basicConfig(filename="parseLabelbox.log", encoding="utf-8", level=logging.DEBUG)
 
 
+def _register_extensions():
+    Doc.set_extension("rel", default=list(), force=True)
+    Doc.set_extension("rel_ready", default=list(), force=True)
+    Span.set_extension("span_rels", default=list(), force=True)
+
+
+class DocumentExtraction:
+    """
+    What `extract_ent_rel_pairs` pulls out of a single Labelbox item.
+    entities: (ent_id, name, start, end) and relations: (rel_id, name, subject, object, text, doc_id).
+    Unpacks like the old (text, entities, relations) tuples.
+    """
+
+    __slots__ = ("doc_id", "text", "entities", "relations")
+
+    def __init__(
+        self,
+        doc_id: str,
+        text: str,
+        entities: List[Tuple[str, str, int, int]],
+        relations: List[Tuple[str, str, str, str, str, str]],
+    ):
+        self.doc_id = doc_id
+        self.text = text
+        self.entities = entities
+        self.relations = relations
+
+    def __iter__(self):
+        return iter((self.text, self.entities, self.relations))
+
+    def __repr__(self):
+        return f"DocumentExtraction(doc_id={self.doc_id!r}, entities={len(self.entities)}, relations={len(self.relations)})"
+
+
 class EntityRelationshipExtractor:
     def __init__(
         self,
@@ -23,16 +66,17 @@ class EntityRelationshipExtractor:
         entity_locations_file: str,
         relationships_file: str,
     ):
+        self.nlp_model = nlp_model
         self.nlp = spacy.blank(nlp_model)
         self.entity_mapping = entity_mapping
         self.relationship_mapping = relationship_mapping
         self.entity_locations_file = entity_locations_file
         self.relationships_file = relationships_file
         self.annotated_spacy_docs = list()
+        self.entity_index = None
+        self.extracted_documents = list()
 
-        Doc.set_extension("rel", default=list(), force=True)
-        Doc.set_extension("rel_ready", default=list(), force=True)
-        Span.set_extension("span_rels", default=list(), force=True)
+        _register_extensions()
 
         self.entity_lv1_lv2 = self.load_mapping(
             "path_to_entity_naming_map", delimiter="\t"
@@ -58,11 +102,15 @@ class EntityRelationshipExtractor:
                 )
 
     @staticmethod
-    def gather_entity_info(ent_id: str, df: pd.DataFrame):
+    def gather_entity_info(ent_id: str, ent_data: Union[EntityIndex, pd.DataFrame]):
         """
-        A dictionary of sorts, that holds info about the entities in our dataset. Careful tho, you have to instatiate and populate the dataframe first.
+        A dictionary of sorts, that holds info about the entities in our dataset. Careful tho, you have to instatiate and populate the index (or dataframe) first.
+        Prefer passing an `EntityIndex`, the dataframe path scans every row on each call.
         """
-        ent = df[df["id"] == ent_id]
+        if isinstance(ent_data, EntityIndex):
+            return ent_data.lookup(ent_id)
+
+        ent = ent_data[ent_data["id"] == ent_id]
 
         start = ent.start.values[0]
         end = ent.end.values[0]
@@ -70,52 +118,51 @@ class EntityRelationshipExtractor:
 
         return start, end, type
 
-    @staticmethod
     def apply_doc_level_annotations(
-        self, annotated_docs: List[Doc], ent_data: pd.DataFrame
+        self,
+        annotated_docs: List[Doc],
+        ent_data: Union[EntityIndex, pd.DataFrame, None] = None,
+        n_process: int = 1,
+        batch_size: int = 1000,
     ) -> List[Doc]:
         """
         Spacy is super nice and allows us to add custom attributes to the Doc object. We can use this as an additional annotatio layer to store the relationships in the doc object itself.
         There are many annotation levels for Spacy Tokens, Spans and (in our case) Docs. We can use the doc level annotations to store the relationships.
         See here for more: https://spacy.io/api/doc
+        If no entity data is passed we fall back to the index built by `extract_ent_rel_pairs`.
+        Empty entity data is fine as long as the docs have no entities either (an export without any labels).
+        All docs are annotated in one pass; with n_process > 1 the docs are split in batches of batch_size over a process pool.
         """
-        if ent_data:
-            for doc in annotated_docs:
-                ents = list(doc.ents)
-                ent_ids = [ent.id_ for ent in ents]
-                rels = doc._.rel
-
-                ent_pair_combinations = list(combinations(ent_ids, 2))
-                count = 0
-                rel_ready_dict = {}
-                for key in rels:
-                    subject, object, relation = rels.get(key)
-                    s_o_tuple = tuple((subject, object))
-
-                    for pair in ent_pair_combinations:
-                        if pair == s_o_tuple:
-                            count += 1
-
-                            (
-                                subject_start,
-                                subject_end,
-                                _,
-                            ) = self.__class__.gather_entity_info(subject, ent_data)
-                            (
-                                object_start,
-                                object_end,
-                                _,
-                            ) = self.__class__.gather_entity_info(object, ent_data)
-
-                            relation = "_".join(relation.split(" "))
-                            rel_ready_dict[
-                                key
-                            ] = f"{subject_start+1};{subject_end+1};{object_start+1};{object_end+1};{relation}"
-
-                doc._.rel_ready = rel_ready_dict
-                logging.debug(f"Number of relationships in doc: {len(doc._.rel_ready)}")
+        if ent_data is None:
+            ent_data = self.entity_index
+        if ent_data is None or (
+            len(ent_data) == 0 and any(doc.ents for doc in annotated_docs)
+        ):
+            raise ValueError("No entity data provided")
+        if isinstance(ent_data, pd.DataFrame):
+            ent_data = EntityIndex.from_dataframe(ent_data)
+
+        payload = [([ent.id_ for ent in doc.ents], doc._.rel) for doc in annotated_docs]
+
+        if n_process > 1 and len(payload) > batch_size:
+            chunks = [
+                payload[i : i + batch_size] for i in range(0, len(payload), batch_size)
+            ]
+            with ProcessPoolExecutor(
+                max_workers=n_process,
+                initializer=_init_annotation_worker,
+                initargs=(ent_data,),
+            ) as executor:
+                rel_ready_dicts = list(
+                    chain.from_iterable(executor.map(_annotate_chunk_in_worker, chunks))
+                )
         else:
-            ValueError("No entity data provided")
+            rel_ready_dicts = _annotate_chunk(payload, ent_data)
+
+        for doc, rel_ready_dict in zip(annotated_docs, rel_ready_dicts):
+            doc._.rel_ready = rel_ready_dict
+            logging.debug(f"Number of relationships in doc: {len(doc._.rel_ready)}")
+        return annotated_docs
 
     def load_mapping(self, file_path: str, delimiter: str) -> dict:
         mapping = {}
@@ -139,106 +186,381 @@ class EntityRelationshipExtractor:
             return yaml.safe_load(file)
 
     def extract_ent_rel_pairs(
-        self, dataset: List[Dict]
-    ) -> List[Tuple[str, List[Tuple], List[Tuple]]]:
-        prepared_dataset = list()  # List[str,List,List]
-        rel_tuples = (
-            list()
-        )  # store relationships here momentarily and use to populate [entity pair]-[relation] in doc._.rel
-        ent_spans_locations = (
-            list()
-        )  # store entity id and entity span locations s.t. we can retrieve them later
-        total_rels = list()
+        self,
+        dataset: Iterable[Dict],
+        flush_every: int = 10000,
+        n_process: int = 1,
+        batch_size: int = 64,
+    ) -> List["DocumentExtraction"]:
+        """
+        dataset can be any iterable of Labelbox items, e.g. `iter_json(path)` to stream a large export.
+        Entity locations and relationships are streamed to their CSV files once per document (see `ExtractionSink`),
+        buffered in bulk writes of flush_every rows.
+        Every document yields one `DocumentExtraction` holding only its own entities and relations, which is appended to
+        `self.extracted_documents` and returned.
+        With n_process > 1 the items are tokenised and annotated in batches of batch_size by a process pool,
+        the CSVs and docs come out in the same order as in the serial run.
+        """
+        if n_process > 1:
+            extracted = self._extract_parallel(
+                enumerate(dataset), n_process, batch_size
+            )
+        else:
+            extracted = self._extract_serial(enumerate(dataset), batch_size)
+        return self._collect(extracted, flush_every)
+
+    def extract_incremental(
+        self,
+        dataset: Iterable[Dict],
+        cache_dir: str = "data/item_cache",
+        flush_every: int = 10000,
+        n_process: int = 1,
+        batch_size: int = 64,
+    ) -> List["DocumentExtraction"]:
+        """
+        `extract_ent_rel_pairs` for a refreshed export: only the items that are new or whose text, labels or mappings
+        changed since the previous run (see `ItemCache`) are tokenised and annotated, the others come from the cache.
+        The output (CSVs, docs, returned extractions) is the same as a full run, in the order of the export,
+        and the cache is replaced by the items of this export.
+        """
+        cache = ItemCache(cache_dir)
+        mappings = mapping_digest(
+            {"nlp_model": self.nlp_model},
+            self.entity_mapping,
+            self.relationship_mapping,
+            self.entity_lv1_lv2,
+            self.rel_ontology_mapping,
+        )
+        manifest = cache.manifest(mappings)
 
+        # Only the changed items are kept in memory, the unchanged ones are just an (ID, hash) placeholder
+        order, changed = [], []
         for idx, item in enumerate(dataset):
-            total_ents = list()
-
-            doc_id = item["ID"]
-            text = item["Labeled Data"]
-            ents = item["Label"]["objects"]
-            doc = self.nlp(text)
-            ent_spans = []
-            for ent in ents:
-                start_pos = ent["data"]["location"]["start"]
-                end_pos = ent["data"]["location"]["end"]
-                name = ent["title"]
-
-                repl_name = self.entity_lv1_lv2.get(
-                    name
-                )  # apply lvl1 to lvl2 entity mapping as provided by Jaap
-
-                if not isinstance(repl_name, type(None)):
-                    name = repl_name
-                ent_id = ent["featureId"]
-                ent_text = text[start_pos : end_pos + 1]
-
-                total_ents.append((ent_id, name, start_pos, end_pos))
-
-                span = doc.char_span(
-                    start_pos,
-                    end_pos,
-                    label=name,
-                    alignment_mode="expand",
-                    kb_id=ent_id,
-                )
-                span.id_ = ent_id
-                ent_spans.append(
-                    Span(doc, span.start, span.end, name, span_id=span.id_)
-                )
+            digest = item_hash(item, mappings)
+            is_cached = manifest.get(item["ID"]) == digest
+            order.append((item["ID"], digest, is_cached))
+            if not is_cached:
+                changed.append((idx, item))
+        cached = cache.load(
+            {item_id for item_id, _, hit in order if hit}, self.nlp.vocab
+        )
+        logging.info(
+            f"{len(order) - len(changed)} of {len(order)} items unchanged since the last run, extracting {len(changed)}"
+        )
 
-                ent_spans_locations.append(
-                    [span.id_, span.start, span.end - 1, name, ent_text]
-                )
+        if n_process > 1:
+            extracted = self._extract_parallel(changed, n_process, batch_size)
+        else:
+            extracted = self._extract_serial(changed, batch_size)
+
+        entries = []
 
-            try:
-                doc.set_ents(ent_spans)
-            except:
-                print(f"Item {idx} failed")
-                print(text)
-
-            self.annotated_spacy_docs.append(doc)
-
-            with open(self.entity_locations_file, "w", newline="") as ent1:
-                csv_writer = csv.writer(ent1)
-                csv_writer.writerows(ent_spans_locations)
-
-            relationships = item["Label"]["relationships"]
-            rel_dict = {}
-            for rel in relationships:
-                contents = rel["data"].keys()
-
-                subject = rel["data"]["source"]
-                object = rel["data"]["target"]
-
-                if "label" in contents:
-                    name = rel["data"]["label"]
-                    self.set_of_rels.add(name.lower())
-                    # print(name.lower())
-                repl_name = self.rel_ontology_mapping.get(name.lower())
-                if not isinstance(repl_name, type(None)):
-                    name = repl_name  # Change relationship name to a higher one using Jaaps mapping scheme
+        def merged():
+            for item_id, digest, is_cached in order:
+                if is_cached:
+                    doc, entities, relations, doc_ent_rows, rel_labels = cached[item_id]
+                    extraction = DocumentExtraction(
+                        item_id, doc.text, entities, relations
+                    )
                 else:
-                    name = "action_misc"
+                    doc, extraction, doc_ent_rows, rel_labels = next(extracted)
+                entries.append(
+                    (
+                        item_id,
+                        digest,
+                        doc,
+                        extraction.entities,
+                        extraction.relations,
+                        doc_ent_rows,
+                        rel_labels,
+                    )
+                )
+                yield doc, extraction, doc_ent_rows, rel_labels
+            extracted.close()  # shuts the process pool of the parallel path down
+
+        prepared_dataset = self._collect(merged(), flush_every)
+        cache.save(mappings, entries)
+        return prepared_dataset
+
+    def _collect(self, extracted, flush_every: int) -> List["DocumentExtraction"]:
+        prepared_dataset = list()  # only the documents of this call
+
+        with ExtractionSink(
+            self.entity_locations_file, self.relationships_file, flush_every
+        ) as sink:
+            for doc, extraction, doc_ent_rows, rel_labels in extracted:
+                self.annotated_spacy_docs.append(doc)
+                self.set_of_rels.update(rel_labels)
+
+                prepared_dataset.append(extraction)
+                self.extracted_documents.append(extraction)
+
+                sink.write_document(doc_ent_rows, extraction.relations)
 
-                rel_id = rel["featureId"]
-                total_rels.append((rel_id, name, subject, object, text, doc_id))
+        self.entity_index = EntityIndex.from_csv(self.entity_locations_file)
+        return prepared_dataset
 
-                rel_dict[rel_id] = (subject, object, name)
+    def load_or_extract(
+        self, export_path: str, cache_dir: str = "data/doc_cache", **extract_kwargs
+    ) -> List[Doc]:
+        """
+        Returns the annotated docs (with `rel` and `rel_ready` set) of a Labelbox export, from the DocBin cache when the export
+        and the mappings have not changed, otherwise extracts them (streaming the export) and fills the cache.
+        On a cache hit the CSVs and the entity index are not touched, the docs already carry everything the training data export needs.
+        """
+        cache = DocCache(cache_dir)
+        key = cache_key(
+            export_path,
+            {"nlp_model": self.nlp_model},
+            self.entity_mapping,
+            self.relationship_mapping,
+            self.entity_lv1_lv2,
+            self.rel_ontology_mapping,
+        )
 
+        docs = cache.load(key, self.nlp.vocab)
+        if docs is not None:
+            self.annotated_spacy_docs.extend(docs)
+            return docs
+
+        first_new_doc = len(self.annotated_spacy_docs)
+        self.extract_ent_rel_pairs(iter_json(export_path), **extract_kwargs)
+        docs = self.annotated_spacy_docs[first_new_doc:]
+        self.apply_doc_level_annotations(docs)
+        cache.save(key, docs)
+        return docs
+
+    def _extract_serial(self, indexed: Iterable[Tuple[int, Dict]], batch_size: int):
+        texts = ((item["Labeled Data"], (idx, item)) for idx, item in indexed)
+        for doc, (idx, item) in self.nlp.pipe(
+            texts, as_tuples=True, batch_size=batch_size
+        ):
+            yield (doc,) + _extract_item(
+                doc, idx, item, self.entity_lv1_lv2, self.rel_ontology_mapping
+            )
+
+    def _extract_parallel(
+        self, indexed: Iterable[Tuple[int, Dict]], n_process: int, batch_size: int
+    ):
+        """
+        Shards the items in batches over a process pool. At most 2 * n_process batches are in flight,
+        and results are taken back in submission order, so the output matches the serial path.
+        """
+        pending = deque()
+        with ProcessPoolExecutor(
+            max_workers=n_process,
+            initializer=_init_extraction_worker,
+            initargs=(self.nlp_model, self.entity_lv1_lv2, self.rel_ontology_mapping),
+        ) as executor:
+            for batch in _batched(indexed, batch_size):
+                pending.append(executor.submit(_extract_batch_in_worker, batch))
+                if len(pending) >= 2 * n_process:
+                    yield from self._restore_docs(pending.popleft().result())
+            while pending:
+                yield from self._restore_docs(pending.popleft().result())
+
+    def _restore_docs(self, results: List[Tuple]):
+        for doc_bytes, rel_dict, extraction, doc_ent_rows, rel_labels in results:
+            doc = Doc(self.nlp.vocab).from_bytes(doc_bytes)
             doc._.rel = rel_dict
+            yield doc, extraction, doc_ent_rows, rel_labels
+
+
+def _extract_item(
+    doc: Doc,
+    idx: int,
+    item: Dict,
+    entity_lv1_lv2: Dict[str, str],
+    rel_ontology_mapping: Dict[str, str],
+) -> Tuple[DocumentExtraction, List[List], set]:
+    """
+    Sets the entities and the `rel` extension of an already tokenised Labelbox item.
+    Lives at module level so the worker processes of the parallel extraction can run it too.
+    """
+    doc_ents = list()
+    doc_rels = list()
+    doc_ent_rows = list()
+    rel_labels = set()
+
+    doc_id = item["ID"]
+    text = item["Labeled Data"]
+    ents = item["Label"]["objects"]
+    ent_spans = []
+    for ent in ents:
+        start_pos = ent["data"]["location"]["start"]
+        end_pos = ent["data"]["location"]["end"]
+        name = ent["title"]
+
+        repl_name = entity_lv1_lv2.get(
+            name
+        )  # apply lvl1 to lvl2 entity mapping as provided by Jaap
+
+        if not isinstance(repl_name, type(None)):
+            name = repl_name
+        ent_id = ent["featureId"]
+        ent_text = text[start_pos : end_pos + 1]
+
+        doc_ents.append((ent_id, name, start_pos, end_pos))
+
+        span = doc.char_span(
+            start_pos,
+            end_pos,
+            label=name,
+            alignment_mode="expand",
+            kb_id=ent_id,
+        )
+        span.id_ = ent_id
+        ent_spans.append(Span(doc, span.start, span.end, name, span_id=span.id_))
+
+        doc_ent_rows.append([span.id_, span.start, span.end - 1, name, ent_text])
+
+    try:
+        doc.set_ents(ent_spans)
+    except:
+        print(f"Item {idx} failed")
+        print(text)
+
+    relationships = item["Label"]["relationships"]
+    rel_dict = {}
+    for rel in relationships:
+        contents = rel["data"].keys()
+
+        subject = rel["data"]["source"]
+        object = rel["data"]["target"]
+
+        if "label" in contents:
+            name = rel["data"]["label"]
+            rel_labels.add(name.lower())
+        repl_name = rel_ontology_mapping.get(name.lower())
+        if not isinstance(repl_name, type(None)):
+            name = repl_name  # Change relationship name to a higher one using Jaaps mapping scheme
+        else:
+            name = "action_misc"
+
+        rel_id = rel["featureId"]
+        doc_rels.append((rel_id, name, subject, object, text, doc_id))
+
+        rel_dict[rel_id] = (subject, object, name)
+
+    doc._.rel = rel_dict
+
+    return (
+        DocumentExtraction(doc_id, text, doc_ents, doc_rels),
+        doc_ent_rows,
+        rel_labels,
+    )
+
+
+def _batched(iterable: Iterable, batch_size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
 
-            for rel in total_rels:
-                rel_tuples.append(tuple((rel[2], rel[3])))
 
-            prepared_dataset.append((text, total_ents, total_rels))
+_worker_extraction_state = None
 
-        with open(self.relationships_file, "w", newline="") as rel1:
-            csv_writer = csv.writer(rel1)
-            csv_writer.writerows(total_rels)
 
+def _init_extraction_worker(
+    nlp_model: str, entity_lv1_lv2: Dict[str, str], rel_ontology_mapping: Dict[str, str]
+):
+    global _worker_extraction_state
+    _register_extensions()
+    _worker_extraction_state = (
+        spacy.blank(nlp_model),
+        entity_lv1_lv2,
+        rel_ontology_mapping,
+    )
 
-def generate_training_data(annotated_spacy_docs: List[Doc]) -> List[str]:
-    random.seed(42).shuffle(annotated_spacy_docs)
+
+def _extract_batch_in_worker(batch: List[Tuple[int, Dict]]) -> List[Tuple]:
+    """
+    Docs go back as bytes (without user data, the `rel` dict travels next to them) since pickling a Doc drags its whole vocab along.
+    """
+    nlp, entity_lv1_lv2, rel_ontology_mapping = _worker_extraction_state
+    texts = ((item["Labeled Data"], (idx, item)) for idx, item in batch)
+    results = []
+    for doc, (idx, item) in nlp.pipe(texts, as_tuples=True, batch_size=len(batch)):
+        extraction, doc_ent_rows, rel_labels = _extract_item(
+            doc, idx, item, entity_lv1_lv2, rel_ontology_mapping
+        )
+        results.append(
+            (
+                doc.to_bytes(exclude=["user_data"]),
+                doc._.rel,
+                extraction,
+                doc_ent_rows,
+                rel_labels,
+            )
+        )
+    return results
+
+
+def _match_doc_relations(ent_ids: List[str], rels: Dict) -> List[Tuple]:
+    """
+    Keeps the relations whose (subject, object) pair shows up in the doc with the subject before the object,
+    i.e. the pairs `itertools.combinations(ent_ids, 2)` would produce, without materialising them.
+    """
+    first_position, last_position = {}, {}
+    for position, ent_id in enumerate(ent_ids):
+        first_position.setdefault(ent_id, position)
+        last_position[ent_id] = position
+
+    matched = []
+    for key in rels:
+        subject, object, relation = rels[key]
+        if first_position.get(subject, len(ent_ids)) < last_position.get(object, -1):
+            matched.append((key, subject, object, "_".join(relation.split(" "))))
+    return matched
+
+
+def _annotate_chunk(payload: List[Tuple], ent_index: EntityIndex) -> List[Dict]:
+    """
+    Builds the `rel_ready` dict of every (ent_ids, rels) item with a single batch lookup for the whole chunk.
+    """
+    matched_per_doc = [_match_doc_relations(ent_ids, rels) for ent_ids, rels in payload]
+    matched_flat = list(chain.from_iterable(matched_per_doc))
+
+    subject_starts, subject_ends, _ = ent_index.lookup_many(
+        [subject for _, subject, _, _ in matched_flat]
+    )
+    object_starts, object_ends, _ = ent_index.lookup_many(
+        [object for _, _, object, _ in matched_flat]
+    )
+
+    rel_ready_dicts = []
+    i = 0
+    for matched in matched_per_doc:
+        rel_ready_dict = {}
+        for key, _, _, relation in matched:
+            rel_ready_dict[key] = (
+                f"{subject_starts[i]+1};{subject_ends[i]+1};"
+                f"{object_starts[i]+1};{object_ends[i]+1};{relation}"
+            )
+            i += 1
+        rel_ready_dicts.append(rel_ready_dict)
+    return rel_ready_dicts
+
+
+_worker_entity_index = None
+
+
+def _init_annotation_worker(ent_index: EntityIndex):
+    global _worker_entity_index
+    _worker_entity_index = ent_index
+
+
+def _annotate_chunk_in_worker(payload: List[Tuple]) -> List[Dict]:
+    return _annotate_chunk(payload, _worker_entity_index)
+
+
+def generate_training_data(
+    annotated_spacy_docs: List[Doc], mode: str = "BIO", n_process: int = 3
+) -> List[str]:
+    """
+    Shuffles the docs into train/dev/test and exports each split. With n_process > 1 the splits are exported
+    concurrently, each in its own process. Returns the paths of the written files.
+    """
+    random.Random(42).shuffle(annotated_spacy_docs)
 
     split_1 = int(0.65 * len(annotated_spacy_docs))
     split_2 = int(0.80 * len(annotated_spacy_docs))
@@ -253,140 +575,201 @@ def generate_training_data(annotated_spacy_docs: List[Doc]) -> List[str]:
     current_time = datetime.datetime.now()
     today = str(current_time.day) + "_" + str(current_time.month)
 
-    export_training_data(train_filenames, f"train_{today}", mode="BIO")
-    export_training_data(dev_filenames, f"dev_{today}", mode="BIO")
-    export_training_data(test_filenames, f"test_{today}", mode="BIO")
+    splits = [
+        (train_filenames, f"train_{today}"),
+        (dev_filenames, f"dev_{today}"),
+        (test_filenames, f"test_{today}"),
+    ]
+
+    if n_process > 1:
+        # Docs travel as DocBin bytes, pickling them one by one would drag the vocab along with every doc.
+        with ProcessPoolExecutor(max_workers=min(n_process, len(splits))) as executor:
+            futures = [
+                executor.submit(
+                    _export_split_in_worker,
+                    DocBin(store_user_data=True, docs=docs).to_bytes(),
+                    split,
+                    mode,
+                )
+                for docs, split in splits
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [_timed_export(docs, split, mode) for docs, split in splits]
+
+    for (_, split), (output, n_docs, n_tokens, seconds) in zip(splits, results):
+        seconds = max(seconds, 1e-9)
+        logging.info(
+            f"{split}: {n_docs} docs, {n_tokens} tokens in {seconds:.2f}s "
+            f"({n_docs / seconds:.1f} docs/s, {n_tokens / seconds:.1f} tokens/s)"
+        )
     logging.info(f"Exported training")
+    return [output for output, _, _, _ in results]
+
+
+def _timed_export(
+    docs: List[Doc], split: str, mode: str
+) -> Tuple[str, int, int, float]:
+    t = time()
+    output, n_docs, n_tokens = export_training_data(docs, split, mode=mode)
+    return output, n_docs, n_tokens, time() - t
+
 
+def _export_split_in_worker(
+    doc_bytes: bytes, split: str, mode: str
+) -> Tuple[str, int, int, float]:
+    _register_extensions()
+    docs = list(DocBin().from_bytes(doc_bytes).get_docs(Vocab()))
+    return _timed_export(docs, split, mode)
 
-def export_training_data(annotated_spacy_docs: List[Doc], split: str, mode="conllu"):
+
+def _parse_relations(rel_ready: Iterable[str]) -> List[Tuple]:
+    """
+    Parses the "h1;h2;t1;t2;rel" strings once into (closes_at, order, h1, h2, t1, t2, rel) tuples, sorted by the
+    offset where the relation closes (max of h2 and t2). `order` is the original position, used to restore it per sentence.
+    """
+    parsed = list()
+    for order, rel in enumerate(rel_ready):
+        h1, h2, t1, t2, relation = rel.split(";")[:5]
+        h1, h2, t1, t2 = int(h1), int(h2), int(t1), int(t2)
+        parsed.append((max(h2, t2), order, h1, h2, t1, t2, relation))
+    parsed.sort()
+    return parsed
+
+
+def export_training_data(
+    annotated_spacy_docs: Iterable[Doc],
+    split: str,
+    mode="conllu",
+    buffer_size: int = 1 << 20,
+) -> Tuple[str, int, int]:
     """
     Exports the training data in the (BIOES)[https://stackoverflow.com/questions/17116446/what-do-the-bilou-tags-mean-in-named-entity-recognition]
     or [CONLLU](https://universaldependencies.org/format.html) format.
+    Every doc is written as soon as it is formatted through a buffered file, so only one doc is held in memory.
+    Returns the output path and the number of docs and tokens written.
     """
 
-    document = list()
+    if mode == "conllu":
+        output = f"data/from_json/{split}.{mode}"
+    else:
+        output = f"data/from_json/{split}.txt"
+    logging.info(f"Writing {mode} to {output}")
+
+    document = list()  # fragments of the doc being formatted
+    n_docs, n_tokens = 0, 0
 
     if mode == "conllu":
         logging.info(f"Output type: {mode}")
         document.append("# global.columns = " + ("\t").join(["id", "text", "ner"]))
 
-    for doc in annotated_spacy_docs:
-        word_positions_dict = dict()
-        current_document = []
-
-        tags = [
-            token.ent_iob_ + "-" + "_".join((token.ent_type_.split(" ")))
-            if token.ent_iob_ != "O"
-            else "O"
-            for token in doc
-        ]
-
-        biluo_tags = iob_to_biluo(tags)
-
-        for i, tag in enumerate(biluo_tags):
-            if tag.startswith("U-"):
-                biluo_tags[i] = tag.replace("U-", "S-")
-            if tag.startswith("L-"):
-                biluo_tags[i] = tag.replace("L-", "E-")
-
-        tags = biluo_tags
-
-        if mode == "bio":
-            document.append("-DOCSTART-" + "\t" + "-X-")
-            document.append("\n\n")
-
-        elif mode == "conllu":
-            document.append("")
-            text = "# text = " + doc.text
-            rels = "# relations = " + ("|").join([*doc._.rel_ready.values()])
-
-            rels_flat = list([doc._.rel_ready.values()][0])
-
-        sentence = "# text = "
-        tag_sanity_check = set()
-
-        start_position, end_position = 0, 0
-        end_of_prev_sentence = 0
-
-        ner_lines = list()
-        rel_lines = list()
-        counter = 1
-        for i, word_tag in enumerate(zip(doc, tags)):
-            if mode == "conllu":
-                word_positions_dict[i] = word_tag[0]
-                line = ("\t").join([str(counter), str(word_tag[0]), str(tags[i])])
-                counter += 1
-
-                tag_sanity_check.add(str(word_tag[1]))
-                ner_lines.append(line)
-
-                if str(word_tag[0]) == "." or str(word_tag[0]) == "?":
-                    end_of_prev_sentence = i - end_of_prev_sentence
-                    start_position = list(word_positions_dict.keys())[0]
-                    end_position = list(word_positions_dict.keys())[-1]
-
-                    current_document = doc[start_position : end_position + 1]
-                    rel_flag = False  # whether relations exist for this sentence
-                    for rel in rels_flat:
-                        # Get the positions of the entities {h: head, t: tail} in the relation and the relation itself.
-                        h1, h2, t1, t2, relation = rel.split(";")[:5]
-
-                        if (
-                            (int(h1) >= int(start_position))
-                            and (int(h2) <= int(end_position))
-                        ) and ((int(t2) <= int(end_position))):
-                            h1 = int(h1) - start_position
-                            h2 = int(h2) - start_position
-                            t1 = int(t1) - start_position
-                            t2 = int(t2) - start_position
+    with open(output, "w", encoding="utf-8", buffering=buffer_size) as outfile:
+        for doc, tags in iter_bioes_tagged(annotated_spacy_docs):
+            current_document = []
+
+            if mode == "bio":
+                document.append("-DOCSTART-" + "\t" + "-X-")
+                document.append("\n\n")
+
+            elif mode == "conllu":
+                document.append("")
+                text = "# text = " + doc.text
+                rels = "# relations = " + ("|").join([*doc._.rel_ready.values()])
+
+                rels_sorted = _parse_relations(doc._.rel_ready.values())
+                next_rel = (
+                    0  # relations before this one closed inside an earlier sentence
+                )
+
+            sentence = "# text = "
+            tag_sanity_check = set()
+
+            start_position, end_position = 0, 0
+            sentence_start = 0
+
+            ner_lines = list()
+            rel_lines = list()
+            counter = 1
+            for i, word_tag in enumerate(zip(doc, tags)):
+                if mode == "conllu":
+                    line = ("\t").join([str(counter), str(word_tag[0]), str(tags[i])])
+                    counter += 1
+
+                    tag_sanity_check.add(str(word_tag[1]))
+                    ner_lines.append(line)
+
+                    if str(word_tag[0]) == "." or str(word_tag[0]) == "?":
+                        start_position = sentence_start
+                        end_position = i
+
+                        current_document = doc[start_position : end_position + 1]
+                        # Sweep over the relations in the order they close. Every relation closing in this stretch is looked at
+                        # exactly once: it either starts inside it, or it starts before it and can never fit a later sentence either.
+                        matched = list()
+                        while (
+                            next_rel < len(rels_sorted)
+                            and rels_sorted[next_rel][0] <= end_position
+                        ):
+                            _, order, h1, h2, t1, t2, relation = rels_sorted[next_rel]
+                            next_rel += 1
+                            # Get the positions of the entities {h: head, t: tail} in the relation and the relation itself.
+                            if h1 >= start_position:
+                                matched.append((order, h1, h2, t1, t2, relation))
+
+                        matched.sort()  # keep the order of doc._.rel_ready in the output
+                        for _, h1, h2, t1, t2, relation in matched:
+                            h1 = h1 - start_position
+                            h2 = h2 - start_position
+                            t1 = t1 - start_position
+                            t2 = t2 - start_position
                             rel = (";").join(
                                 [str(h1), str(h2), str(t1), str(t2), relation]
                             )
 
                             rel_lines.append(rel)
 
-                            rel_flag = True
+                        # whether relations exist for this sentence
+                        rel_flag = len(rel_lines) > 0
 
-                    if rel_flag:
-                        document.append("\n")
-                        document.append("# text = " + current_document.text)
-                        document.append("\n")
-                        number_of_rels = len(rel_lines)
-                        if number_of_rels == 1:
-                            document.append("# relations = " + rel_lines[0])
-                        else:
-                            relations = ("|").join([rel for rel in rel_lines[:-1]])
-                            document.append(
-                                "# relations = " + relations + "|" + rel_lines[-1]
-                            )
-                        document.append("\n")
-                        for line in ner_lines:
-                            document.append(line)
+                        if rel_flag:
+                            document.append("\n")
+                            document.append("# text = " + current_document.text)
+                            document.append("\n")
+                            number_of_rels = len(rel_lines)
+                            if number_of_rels == 1:
+                                document.append("# relations = " + rel_lines[0])
+                            else:
+                                relations = ("|").join([rel for rel in rel_lines[:-1]])
+                                document.append(
+                                    "# relations = " + relations + "|" + rel_lines[-1]
+                                )
                             document.append("\n")
+                            for line in ner_lines:
+                                document.append(line)
+                                document.append("\n")
+                            document.append("\n")
+                            sentence = "# text = "
+                            # the next sentence starts right after this token
+                            sentence_start = i + 1
+
+                            ner_lines = list()
+                            rel_lines = list()
+                            counter = 1
+                else:
+                    document.append(
+                        ("\t").join([str(i + 1), str(word_tag[0]), str(word_tag[1])])
+                    )
+                    if str(word_tag[0]) == "." or str(word_tag[0]) == "?":
                         document.append("\n")
-                        sentence = "# text = "
-                        word_positions_dict = (
-                            dict()
-                        )  # RE INITIALIZE DICT TO SAVE THE POSITIONS OF THE NEW SENTENCE
-
-                        ner_lines = list()
-                        rel_lines = list()
-                        counter = 1
-            else:
-                document.append(
-                    ("\t").join([str(i + 1), str(word_tag[0]), str(word_tag[1])])
-                )
-                if str(word_tag[0]) == "." or str(word_tag[0]) == "?":
+
                     document.append("\n")
+            document.append("\n\n\n")
 
-                document.append("\n")
-        document.append("\n\n\n")
+            n_docs += 1
+            n_tokens += len(doc)
+            outfile.write("".join(document))
+            document = list()
 
-    if mode == "conllu":
-        output = f"data/from_json/{split}.{mode}"
-    else:
-        output = f"data/from_json/{split}.txt"
-    logging.info(f"Writing {mode} to {output}")
-    with open(output, "w", encoding="utf-8") as outfile:
         outfile.write("".join(document))
+
+    return output, n_docs, n_tokens
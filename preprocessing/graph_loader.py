@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import sqlite3
+from collections import defaultdict
+from itertools import islice
+from typing import Dict, Iterable, List, Set, Tuple
+
+from .writers import triplet_rows
+
+# Property keys of the node ids, the same the bulk import gives them (source:ID(Subject-ID), target:ID(Object-ID)).
+_NODE_KEYS = {"subject": "source", "object": "target"}
+
+
+class LoadedIndex:
+    """
+    Persistent SQLite index of what is already in the graph: node / relationship id -> digest of its properties.
+    Lets every run send only the rows that are new or changed since the previous runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS loaded "
+            "(kind TEXT NOT NULL, id TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (kind, id))"
+        )
+        self.connection.commit()
+
+    def changed(self, kind: str, rows: Dict[str, List]) -> Dict[str, List]:
+        """
+        The rows (id -> row) whose id is not in the index yet, or whose properties changed.
+        """
+        known = {}
+        ids = list(rows)
+        # in chunks, to stay below SQLite's limit on host parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            known.update(
+                self.connection.execute(
+                    f"SELECT id, digest FROM loaded WHERE kind = ? AND id IN ({','.join('?' * len(chunk))})",
+                    [kind, *chunk],
+                )
+            )
+        return {
+            row_id: row
+            for row_id, row in rows.items()
+            if known.get(row_id) != _row_digest(row)
+        }
+
+    def mark(self, kind: str, rows: Dict[str, List]):
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO loaded (kind, id, digest) VALUES (?, ?, ?)",
+            [(kind, row_id, _row_digest(row)) for row_id, row in rows.items()],
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def count(self, kind: str) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM loaded WHERE kind = ?", (kind,)
+        ).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class DeltaGraphLoader:
+    """
+    Incremental alternative to the full `neo4j-admin` import with --overwrite-destination. Triplets are read
+    batch_size at a time, rows already loaded with the same properties (see `LoadedIndex`) are dropped, and the rest
+    is applied with one `UNWIND $rows ... MERGE` statement per node label or relationship type. The nodes and
+    relationships get the same ids and properties as with `Neo4jImportWriter`, so a bulk imported graph can be
+    kept up to date with it. Every node label gets an index on its id property the first time it is merged, so the
+    MERGE and MATCH lookups do not scan all nodes of the label.
+    """
+
+    def __init__(self, session, index_path: str, batch_size: int = 1000):
+        self.session = session
+        self.index = LoadedIndex(index_path)
+        self.batch_size = batch_size
+        self._indexed: Set[Tuple[str, str]] = set()
+
+    def load(self, triplets: Iterable) -> Dict[str, int]:
+        """
+        Loads the new and changed rows of the triplets, returns the number of rows sent per kind.
+        """
+        sent = defaultdict(int)
+        iterator = iter(triplets)
+        while batch := list(islice(iterator, self.batch_size)):
+            rows = {"subject": {}, "object": {}, "relationship": {}}
+            for triplet in batch:
+                subject_row, object_row, relationship_row = triplet_rows(triplet)
+                rows["subject"][subject_row[0]] = subject_row
+                rows["object"][object_row[0]] = object_row
+                rows["relationship"][relationship_row[0]] = relationship_row
+
+            delta = {kind: self.index.changed(kind, rows[kind]) for kind in rows}
+            for kind in ("subject", "object"):
+                self._merge_nodes(kind, delta[kind].values())
+            self._merge_relationships(delta["relationship"].values(), rows)
+
+            # Only recorded once the graph has them (every result is consumed, so a failed statement raises before
+            # this). MERGE is idempotent, so a crash in between only means resending.
+            for kind, kind_rows in delta.items():
+                self.index.mark(kind, kind_rows)
+                sent[kind] += len(kind_rows)
+            self.index.commit()
+
+        logging.info(
+            f"Sent {sent['subject']} subjects, {sent['object']} objects and {sent['relationship']} relationships "
+            f"to the graph, the other rows were already loaded"
+        )
+        return dict(sent)
+
+    def _merge_nodes(self, kind: str, rows: Iterable[List]):
+        by_label = defaultdict(list)
+        for node, label, _, keyword in rows:
+            by_label[label].append({"id": node, "label": label, "keyword": keyword})
+        key = _NODE_KEYS[kind]
+        for label, label_rows in by_label.items():
+            self._ensure_index(label, key)
+            self.session.run(
+                f"UNWIND $rows AS row "
+                f"MERGE (n:{_escape(label)} {{{key}: row.id}}) "
+                f"SET n.label = row.label, n.keyword = row.keyword",
+                rows=label_rows,
+            ).consume()
+
+    def _ensure_index(self, label: str, key: str):
+        if (label, key) not in self._indexed:
+            self.session.run(
+                f"CREATE INDEX IF NOT EXISTS FOR (n:{_escape(label)}) ON (n.{key})"
+            ).consume()
+            self._indexed.add((label, key))
+
+    def _merge_relationships(
+        self, rows: Iterable[List], batch_rows: Dict[str, Dict[str, List]]
+    ):
+        grouped: Dict[Tuple[str, str, str], List[Dict]] = defaultdict(list)
+        for row in rows:
+            relationship, relation, call_id, sentence, start, end = row[:6]
+            subject_label = batch_rows["subject"][start][1]
+            object_label = batch_rows["object"][end][1]
+            grouped[(relation, subject_label, object_label)].append(
+                {
+                    "id": relationship,
+                    "start": start,
+                    "end": end,
+                    "properties": {
+                        "call_id": call_id,
+                        "sentence": sentence,
+                        "context_before": row[6],
+                        "context_after": row[7],
+                        "confidence": float(row[8]),
+                    },
+                }
+            )
+        for (relation, subject_label, object_label), group in grouped.items():
+            self.session.run(
+                f"UNWIND $rows AS row "
+                f"MATCH (s:{_escape(subject_label)} {{source: row.start}}) "
+                f"MATCH (o:{_escape(object_label)} {{target: row.end}}) "
+                f"MERGE (s)-[r:{_escape(relation)} {{id: row.id}}]->(o) "
+                f"SET r += row.properties",
+                rows=group,
+            ).consume()
+
+    def close(self):
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _escape(name: str) -> str:
+    return "`" + str(name).replace("`", "``") + "`"
+
+
+def _row_digest(row: List) -> str:
+    return hashlib.blake2b(
+        json.dumps(row, default=str).encode("utf-8"), digest_size=8
+    ).hexdigest()
@@ -1,33 +1,106 @@
+import hashlib
+import json
 import labelbox
 import os
-import re
+import time
 import uuid
 import logging
 import yaml
-from labelbox import LabelImport, LabelboxError
+from labelbox import LabelImport
+from labelbox.exceptions import LabelboxError
 from labelbox.data.annotation_types import Label, TextData, ObjectAnnotation, TextEntity
 from labelbox.data.serialization import NDJsonConverter
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from spacy.tokens import Doc
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Set, Tuple
+
+from .span_finder import SpanFinder
 
 logging.basicConfig(filename="uploadJob.log", encoding="utf-8", level=logging.DEBUG)
 
 
+def text_digest(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def build_text_index(data_rows) -> Dict[str, List[str]]:
+    """
+    Text digest -> uids of the data rows with that text, in data row order.
+    """
+    index = defaultdict(list)
+    for data_row in data_rows:
+        if data_row.row_data is not None:
+            index[text_digest(data_row.row_data)].append(data_row.uid)
+    return dict(index)
+
+
+def _ndjson_chunks(
+    rows: Iterable[Dict[str, Any]], max_chunk_bytes: int
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Groups NDJSON rows into chunks whose serialised size stays below max_chunk_bytes (a bigger row gets a chunk
+    of its own). The chunks only depend on the rows, so a rerun over the same labels gives the same chunks.
+    """
+    chunk, size = [], 0
+    for row in rows:
+        row_size = len(json.dumps(row, default=str)) + 1
+        if chunk and size + row_size > max_chunk_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(row)
+        size += row_size
+    if chunk:
+        yield chunk
+
+
+def _chunk_digest(project_id: str, chunk: List[Dict[str, Any]]) -> str:
+    """
+    Identifies a label chunk in the progress file by its project and content, so a progress file reused for other
+    labels or another project never skips a chunk.
+    """
+    digest = hashlib.sha1(project_id.encode("utf-8"))
+    for row in chunk:
+        digest.update(json.dumps(row, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _read_acknowledged_chunks(progress_file: str) -> Set[str]:
+    if progress_file is None or not os.path.exists(progress_file):
+        return set()
+    with open(progress_file) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
 class DataLabellingService:
-    def __init__(self, api_key: str, ontology_id: str = None):
+    def __init__(
+        self,
+        api_key: str,
+        ontology_id: str = None,
+        client: labelbox.Client = None,
+        config_path: str = "config.yaml",
+        label_import=LabelImport,
+    ):
+        """
+        Pass client (and label_import) to use an already configured client instead, e.g. the `FakeLabelboxClient` and
+        `FakeLabelImport` of tests/fake_labelbox.py to run locally.
+        """
         try:
-            api_key = os.environ.get("LABELBOX_API_KEY", api_key)
-            if not api_key:
-                raise ValueError(
-                    "LABELBOX_API_KEY environment variable not set or provided as argument"
-                )
+            if client is None:
+                api_key = os.environ.get("LABELBOX_API_KEY", api_key)
+                if not api_key:
+                    raise ValueError(
+                        "LABELBOX_API_KEY environment variable not set or provided as argument"
+                    )
+                client = labelbox.Client(api_key=api_key)
 
-            self.client = labelbox.Client(api_key=api_key)
+            self.client = client
+            self.label_import = label_import
 
             if ontology_id:
                 self.ontology = self.client.get_ontology(ontology_id=ontology_id)
 
-            with open("config.yaml", "r") as file:
+            with open(config_path, "r") as file:
                 self.config = yaml.safe_load(file)
         except Exception as e:
             logging.error(f"Error during initialization: {e}")
@@ -42,18 +115,85 @@ class DataLabellingService:
             logging.error(f"Error creating dataset: {e}")
             raise
 
-    def create_data_rows(self, assets: List[Dict[str, Any]]) -> List[str]:
-        try:
-            task = self.dataset.create_data_rows(assets)
-            task.wait_till_done()
-            if task.errors:
-                logging.error(f"Data row creation errors: {task.errors}")
-            else:
-                logging.info("Data rows created and task completed")
-            return [dr.uid for dr in list(self.dataset.export_data_rows())]
-        except LabelboxError as e:
-            logging.error(f"Error creating data rows: {e}")
-            raise
+    def create_data_rows(
+        self,
+        assets: List[Dict[str, Any]],
+        chunk_size: int = 1000,
+        max_workers: int = 4,
+        max_retries: int = 3,
+        backoff: float = 2.0,
+    ) -> Dict[str, str]:
+        """
+        Creates the data rows in chunks of chunk_size assets, with up to max_workers creation tasks running at once.
+        A chunk that fails is retried max_retries times (waiting backoff, 2 * backoff, ... seconds), with only the
+        assets that were not created yet. Returns global_key -> data row uid, read from the task results instead of
+        exporting the whole dataset.
+        """
+        if any("global_key" not in asset for asset in assets):
+            raise ValueError("Every asset needs a global_key")
+
+        chunks = [
+            assets[start : start + chunk_size]
+            for start in range(0, len(assets), chunk_size)
+        ]
+        uids, failed = {}, []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._create_data_row_chunk, chunk, max_retries, backoff
+                )
+                for chunk in chunks
+            ]
+            for future in futures:
+                chunk_uids, chunk_failed = future.result()
+                uids.update(chunk_uids)
+                failed.extend(chunk_failed)
+
+        if failed:
+            logging.error(
+                f"{len(failed)} of {len(assets)} data rows could not be created: {failed[:10]}"
+            )
+        else:
+            logging.info(
+                f"Created {len(uids)} data rows in {len(chunks)} chunks of at most {chunk_size}"
+            )
+        return {
+            asset["global_key"]: uids[asset["global_key"]]
+            for asset in assets
+            if asset["global_key"] in uids
+        }
+
+    def _create_data_row_chunk(
+        self, chunk: List[Dict[str, Any]], max_retries: int, backoff: float
+    ) -> Tuple[Dict[str, str], List[str]]:
+        uids = {}
+        pending = chunk
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                task = self.dataset.create_data_rows(pending)
+                task.wait_till_done()
+                if task.status == "FAILED":
+                    # Task.result raises for a failed task, so the whole chunk is retried
+                    logging.warning(
+                        f"Data row creation task failed (attempt {attempt + 1}): {task.errors}"
+                    )
+                else:
+                    for row in task.result or []:
+                        uids[row["global_key"]] = row["id"]
+                    if task.errors:
+                        logging.warning(
+                            f"Data row creation errors (attempt {attempt + 1}): {task.errors}"
+                        )
+            except (LabelboxError, ValueError) as e:
+                logging.warning(
+                    f"Error creating data rows (attempt {attempt + 1}): {e}"
+                )
+            pending = [asset for asset in pending if asset["global_key"] not in uids]
+            if not pending:
+                break
+        return uids, [asset["global_key"] for asset in pending]
 
     def create_asset(self, doc: Doc) -> Dict[str, str]:
         try:
@@ -63,13 +203,6 @@ class DataLabellingService:
             logging.error(f"Error creating asset: {e}")
             raise
 
-    @staticmethod
-    def get_word_span(text: str, word: str) -> tuple(int, int):
-        p = re.compile(word)
-        for m in p.finditer(text):
-            logging.debug((m.start(), m.end(), m.group()))
-        return m.start(), m.end()
-
     def gather_labels(self, label_payload: list, data_row):
         text_data = TextData(uid=data_row)
         return Label(data=text_data, annotations=label_payload)
@@ -83,41 +216,165 @@ class DataLabellingService:
         named_entity_annotation = ObjectAnnotation(value=named_entity, name=entity_name)
         return named_entity_annotation
 
-    def process_documents_and_create_labels(self, documents: List[Doc], data_rows):
-        labels = []
+    def create_ner_annotations(self, doc: Doc) -> List[ObjectAnnotation]:
+        """
+        `create_ner_annotation` for all entities of a doc at once, looking up the entity mapping a single time.
+        """
+        return self.create_span_annotations(
+            (ent.start_char, ent.end_char, ent.label_) for ent in doc.ents
+        )
+
+    def create_span_annotations(
+        self, spans: Iterable[Tuple[int, int, str]]
+    ) -> List[ObjectAnnotation]:
+        """
+        `create_ner_annotation` for a batch of (start_char, end_char, entity type) spans.
+        """
+        self.entity_mapping = self.config["entity_mapping"]
+        return [
+            ObjectAnnotation(
+                value=TextEntity(start=start, end=end - 1),
+                name=self.entity_mapping.get(type_of_entity, type_of_entity),
+            )
+            for start, end, type_of_entity in spans
+        ]
+
+    def create_pre_labels(
+        self, texts: Iterable[str], span_finder: SpanFinder, batch_size: int = 1000
+    ) -> Iterator[List[ObjectAnnotation]]:
+        """
+        Gazetteer pre-labels: the NER annotations for every match of `span_finder` in each text.
+        """
+        for spans in span_finder.find_all(texts, batch_size=batch_size):
+            yield self.create_span_annotations(spans)
+
+    def process_documents_and_create_labels(
+        self, documents: List[Doc], data_rows
+    ) -> List[Label]:
+        """
+        Matches every doc to the data row holding its text through a text digest index, built once per call.
+        When several data rows hold the same text, the docs with that text are paired with them in order, docs left
+        over once all those rows are used get no label (a data row is never labelled twice).
+        """
+        index = build_text_index(data_rows)
+        duplicates = sum(1 for uids in index.values() if len(uids) > 1)
+        if duplicates:
+            logging.warning(f"{duplicates} texts occur in more than one data row")
+
+        used = defaultdict(int)
+        labels, unmatched = [], 0
         for doc in documents:
-            labels_payload = []
-            doc_uid = None
-            for data_row in data_rows:
-                if doc.text == data_row.row_data:
-                    doc_ents = doc
-                    doc_uid = data_row.uid
-            if doc_uid:  # Proceed only if a matching data row is found
-                for ent in doc_ents.ents:
-                    ner_annotation = self.create_ner_annotation(
-                        ent.start_char, ent.end_char, ent.label_
-                    )
-                    labels_payload.append(ner_annotation)
-                labels.append(self.gather_labels(labels_payload, doc_uid))
+            digest = text_digest(doc.text)
+            uids = index.get(digest)
+            if not uids or used[digest] >= len(uids):
+                unmatched += 1
+                continue
+            doc_uid = uids[used[digest]]
+            used[digest] += 1
+            labels.append(self.gather_labels(self.create_ner_annotations(doc), doc_uid))
+
+        if unmatched:
+            logging.warning(f"{unmatched} documents have no (free) matching data row")
+        logging.info(f"Created labels for {len(labels)} of {len(documents)} documents")
         return labels
 
-    def upload_labels(self, labels: list):
-        try:
-            label_ndjson = list(NDJsonConverter.serialize(labels))
-            upload_job = LabelImport.create_from_objects(
-                client=self.client,
-                project_id=self.dataset.uid,
-                name="lbm2" + str(uuid.uuid1()),
-                labels=label_ndjson,
+    def upload_labels(
+        self,
+        labels: Iterable[Label],
+        max_chunk_bytes: int = 10 << 20,
+        max_in_flight: int = 3,
+        max_retries: int = 3,
+        backoff: float = 2.0,
+        progress_file: str = None,
+    ):
+        """
+        Streams the labels to Labelbox as a series of label import jobs. The labels are serialised lazily and cut
+        into NDJSON chunks of at most max_chunk_bytes, with up to max_in_flight import jobs running at once and failed
+        jobs retried with exponential backoff. The chunks that were imported without errors are recorded in
+        progress_file by a digest of their project and content, so running the same upload again after a failure only
+        sends the chunks that were not acknowledged yet.
+        """
+        done = _read_acknowledged_chunks(progress_file)
+        if done:
+            logging.info(
+                f"Resuming the label upload, {len(done)} chunks already acknowledged"
             )
-            upload_job.wait_until_done()
-            if upload_job.errors:
-                logging.error(f"Label upload errors: {upload_job.errors}")
-            else:
-                logging.info("Labels uploaded successfully")
-        except LabelboxError as e:
-            logging.error(f"Error uploading labels: {e}")
-            raise
+
+        in_flight, n_chunks, n_rows, rejected = deque(), 0, 0, []
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            try:
+                # One label at a time: NDJsonConverter.serialize reads its input twice, so a generator would give no rows
+                rows = (
+                    row
+                    for label in labels
+                    for row in NDJsonConverter.serialize([label])
+                )
+                for index, chunk in enumerate(_ndjson_chunks(rows, max_chunk_bytes)):
+                    digest = _chunk_digest(self.dataset.uid, chunk)
+                    if digest in done:
+                        continue
+                    if len(in_flight) >= max_in_flight:
+                        self._acknowledge(*in_flight.popleft(), progress_file, rejected)
+                    future = executor.submit(
+                        self._import_label_chunk, index, chunk, max_retries, backoff
+                    )
+                    in_flight.append((index, digest, future))
+                    n_chunks += 1
+                    n_rows += len(chunk)
+                while in_flight:
+                    self._acknowledge(*in_flight.popleft(), progress_file, rejected)
+            except LabelboxError as e:
+                logging.error(f"Error uploading labels: {e}")
+                # Still record the jobs that were in flight and succeeded, so a resumed upload does not repeat them
+                for index, digest, future in in_flight:
+                    if future.exception() is None:
+                        self._acknowledge(
+                            index, digest, future, progress_file, rejected
+                        )
+                raise
+
+        if rejected:
+            logging.error(
+                f"{len(rejected)} of {n_chunks} label chunks had import errors and were not acknowledged: {rejected}"
+            )
+        logging.info(f"Uploaded {n_rows} label rows in {n_chunks} import jobs")
+
+    def _import_label_chunk(
+        self, index: int, chunk: List[Dict[str, Any]], max_retries: int, backoff: float
+    ):
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            try:
+                upload_job = self.label_import.create_from_objects(
+                    client=self.client,
+                    project_id=self.dataset.uid,
+                    name=f"lbm2{uuid.uuid1()}-{index}",
+                    labels=chunk,
+                )
+                upload_job.wait_until_done()
+                if upload_job.errors:
+                    logging.error(
+                        f"Label upload errors in chunk {index}: {upload_job.errors}"
+                    )
+                return upload_job.errors
+            except LabelboxError as e:
+                logging.warning(
+                    f"Error uploading label chunk {index} (attempt {attempt + 1}): {e}"
+                )
+                if attempt == max_retries:
+                    raise
+
+    @staticmethod
+    def _acknowledge(
+        index: int, digest: str, future: Future, progress_file: str, rejected: List[int]
+    ):
+        if future.result():
+            # imported with errors, so sent again by a resumed upload
+            rejected.append(index)
+        elif progress_file is not None:
+            with open(progress_file, "a") as f:
+                f.write(f"{digest}\n")
 
     def signing_function_batch(self, obj_bytes: bytes) -> str:
         try:
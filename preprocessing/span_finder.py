@@ -0,0 +1,59 @@
+from spacy.language import Language
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import Doc
+from spacy.util import filter_spans
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from .utils import load_mapping
+
+
+class SpanFinder:
+    """
+    Finds every surface form of a gazetteer (surface form -> entity type) in a doc in one pass, with a spaCy
+    `PhraseMatcher` over all forms at once. Matches are token aligned. By default overlapping matches are resolved
+    like `filter_spans` does (longest first, then earliest), so the spans can be used as NER pre-labels directly.
+    """
+
+    def __init__(
+        self,
+        nlp: Language,
+        surface_forms: Dict[str, str],
+        attr: str = "LOWER",
+        overlapping: bool = False,
+    ):
+        self.nlp = nlp
+        self.overlapping = overlapping
+        self.matcher = PhraseMatcher(nlp.vocab, attr=attr)
+
+        patterns: Dict[str, List[Doc]] = {}
+        forms = list(surface_forms)
+        for form, pattern in zip(forms, nlp.tokenizer.pipe(forms)):
+            if len(pattern):
+                patterns.setdefault(surface_forms[form], []).append(pattern)
+        for entity_type, type_patterns in patterns.items():
+            self.matcher.add(entity_type, type_patterns)
+
+    @classmethod
+    def from_file(cls, nlp: Language, file_path: str, **kwargs) -> "SpanFinder":
+        """
+        Reads the gazetteer from a tab separated file with a surface form and its entity type per line.
+        """
+        return cls(nlp, load_mapping(file_path), **kwargs)
+
+    def find(self, doc: Doc) -> List[Tuple[int, int, str]]:
+        """
+        (start_char, end_char, entity type) of every match in the doc, in document order.
+        """
+        spans = self.matcher(doc, as_spans=True)
+        if not self.overlapping:
+            spans = filter_spans(spans)
+        return [(span.start_char, span.end_char, span.label_) for span in spans]
+
+    def find_all(
+        self, texts: Iterable[str], batch_size: int = 1000
+    ) -> Iterator[List[Tuple[int, int, str]]]:
+        """
+        `find` for a stream of texts, which are only tokenized.
+        """
+        for doc in self.nlp.tokenizer.pipe(texts, batch_size=batch_size):
+            yield self.find(doc)
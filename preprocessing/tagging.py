@@ -0,0 +1,97 @@
+import numpy as np
+from itertools import islice
+from spacy.attrs import ENT_IOB, ENT_TYPE
+from spacy.tokens import Doc
+from typing import Iterable, Iterator, List, Tuple
+
+# Token.ent_iob codes
+_IOB_MISSING, _IOB_I, _IOB_O, _IOB_B = 0, 1, 2, 3
+
+# BIOES prefix codes, "O" has no label attached
+_O, _B, _I, _E, _S = 0, 1, 2, 3, 4
+_PREFIXES = ["O", "B", "I", "E", "S"]
+
+
+def bioes_tags(docs: List[Doc]) -> List[List[str]]:
+    """
+    BIOES tags (S- for single token entities, E- for the last token) for a batch of docs, the same tags as running
+    `iob_to_biluo` over the token IOB tags and renaming U-/L- to S-/E-. Spaces in labels become underscores.
+    The entity attributes of the whole batch are read with `Doc.to_array` and converted with NumPy in one go,
+    strings are only built at the end.
+    """
+    if not docs:
+        return []
+
+    arrays = [doc.to_array([ENT_IOB, ENT_TYPE]) for doc in docs]
+    lengths = np.array([len(doc) for doc in docs], dtype=np.int64)
+    if lengths.sum() == 0:
+        return [[] for _ in docs]
+    values = np.concatenate([array.reshape(-1, 2) for array in arrays])
+    iob = values[:, 0].astype(np.int64)
+    ent_type = values[:, 1]
+
+    if (iob == _IOB_MISSING).any():
+        raise ValueError(
+            "Ill-formed IOB input detected: tokens without entity annotation, set the entities with a default first"
+        )
+
+    # Entity type hashes -> label codes. Labels that only differ in spaces vs underscores end up with the same code.
+    hashes, type_codes = np.unique(ent_type, return_inverse=True)
+    labels, label_codes = [], {}
+    hash_to_code = np.empty(len(hashes), dtype=np.int64)
+    for position, type_hash in enumerate(hashes):
+        label = "_".join(_type_string(docs, int(type_hash)).split(" "))
+        if label not in label_codes:
+            label_codes[label] = len(labels)
+            labels.append(label)
+        hash_to_code[position] = label_codes[label]
+    label = hash_to_code[type_codes.reshape(-1)]
+
+    in_entity = iob != _IOB_O
+    doc_starts = np.zeros(len(iob), dtype=bool)
+    doc_starts[np.cumsum(lengths)[:-1][lengths[1:] > 0]] = True
+    doc_starts[0] = True
+
+    # A token continues the entity of the previous token when it is an I- of the same label within the same doc.
+    continues = np.zeros(len(iob), dtype=bool)
+    continues[1:] = (iob[1:] == _IOB_I) & in_entity[:-1] & (label[1:] == label[:-1])
+    continues &= ~doc_starts
+    begins = in_entity & ~continues
+    ends = np.zeros(len(iob), dtype=bool)
+    ends[:-1] = in_entity[:-1] & ~continues[1:]
+    ends[-1] = in_entity[-1]
+
+    prefix = np.full(len(iob), _O, dtype=np.int64)
+    prefix[begins & ~ends] = _B
+    prefix[~begins & ~ends & in_entity] = _I
+    prefix[~begins & ends] = _E
+    prefix[begins & ends] = _S
+
+    table = np.array(
+        ["O"] + [f"{p}-{l}" for p in _PREFIXES[1:] for l in labels], dtype=object
+    )
+    codes = np.where(prefix == _O, 0, 1 + (prefix - 1) * len(labels) + label)
+    tags = table[codes].tolist()
+
+    bounds = np.concatenate([[0], np.cumsum(lengths)])
+    return [tags[bounds[i] : bounds[i + 1]] for i in range(len(docs))]
+
+
+def iter_bioes_tagged(
+    docs: Iterable[Doc], batch_size: int = 256
+) -> Iterator[Tuple[Doc, List[str]]]:
+    """
+    Pairs every doc with its BIOES tags, tagging `batch_size` docs at a time.
+    """
+    iterator = iter(docs)
+    while batch := list(islice(iterator, batch_size)):
+        yield from zip(batch, bioes_tags(batch))
+
+
+def _type_string(docs: List[Doc], type_hash: int) -> str:
+    if type_hash == 0:
+        return ""
+    for doc in docs:
+        if type_hash in doc.vocab.strings:
+            return doc.vocab.strings[type_hash]
+    raise KeyError(f"Unknown entity type hash: {type_hash}")
@@ -1,5 +1,8 @@
 import json
-from typing import Dict, List
+import re
+from typing import Dict, Iterator, List
+
+_SEPARATORS = re.compile(r"[\s,]*")
 
 
 def read_json(file_path: str) -> List[Dict]:
@@ -7,6 +10,78 @@ def read_json(file_path: str) -> List[Dict]:
         return json.load(f)
 
 
+def iter_json(file_path: str, chunk_size: int = 1 << 20) -> Iterator[Dict]:
+    """
+    Yields the items of a Labelbox export one at a time, without loading the whole file.
+    Works for a top-level JSON array (the regular export) and for NDJSON (one item per line).
+    """
+    with open(file_path, encoding="utf-8") as f:
+        buffer = f.read(chunk_size)
+        stripped = buffer.lstrip()
+        while not stripped:
+            more = f.read(chunk_size)
+            if not more:
+                return
+            stripped = more.lstrip()
+
+        if not stripped.startswith("["):
+            f.seek(0)
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+
+        yield from _iter_json_array(f, stripped[1:], chunk_size)
+
+
+def _iter_json_array(f, buffer: str, chunk_size: int) -> Iterator[Dict]:
+    decoder = json.JSONDecoder()
+    pos = 0
+    eof = False
+    read_size = chunk_size
+
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of file inside the JSON array")
+            more = f.read(chunk_size)
+            eof = not more
+            buffer, pos = more, 0
+            continue
+
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            end = None
+
+        # An item is only complete once a separator follows it: a number cut off by the end of the buffer still
+        # decodes ("1." as 1), so without one read on.
+        if end is None or not (eof or _ends_item(buffer, end)):
+            more = f.read(read_size)
+            eof = not more
+            buffer, pos = buffer[pos:] + more, 0
+            # items bigger than a chunk should not be re-parsed once per chunk
+            read_size *= 2
+            continue
+
+        read_size = chunk_size
+        yield item
+        pos = end
+        if pos >= chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+
+def _ends_item(buffer: str, end: int) -> bool:
+    return end < len(buffer) and (buffer[end] in ",]" or buffer[end].isspace())
+
+
 def load_mapping(file_path: str, delimiter: str = "\t") -> Dict[str, str]:
     mapping = {}
     with open(file_path) as file:
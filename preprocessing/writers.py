@@ -0,0 +1,305 @@
+import csv
+import hashlib
+import logging
+import numpy as np
+import os
+from typing import Iterable, List, Sequence, Tuple
+
+
+class StreamingCSVWriter:
+    """
+    Append-only CSV writer. Rows are buffered and written in bulk every `flush_every` rows to a temporary file,
+    which is atomically renamed to `file_path` on close, so a crashed run never leaves a half written file behind.
+    """
+
+    def __init__(self, file_path: str, flush_every: int = 10000):
+        if flush_every < 1:
+            raise ValueError("flush_every must be at least 1")
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self._tmp_path = f"{file_path}.tmp"
+        self._buffer: List[Sequence] = []
+        self._file = open(self._tmp_path, "w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+
+    def writerow(self, row: Sequence):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def writerows(self, rows: Iterable[Sequence]):
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._writer.writerows(self._buffer)
+            self.rows_written += len(self._buffer)
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        os.replace(self._tmp_path, self.file_path)
+        logging.info(f"Wrote {self.rows_written} rows to {self.file_path}")
+
+    def abort(self):
+        """
+        Drops the temporary file and leaves whatever was at `file_path` untouched.
+        """
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ExtractionSink:
+    """
+    Streams the entity location rows and the relationship rows of every document into their CSV files, once per document.
+    """
+
+    def __init__(
+        self,
+        entity_locations_file: str,
+        relationships_file: str,
+        flush_every: int = 10000,
+    ):
+        self.entities = StreamingCSVWriter(entity_locations_file, flush_every)
+        self.relationships = StreamingCSVWriter(relationships_file, flush_every)
+
+    def write_document(
+        self, entity_rows: Iterable[Sequence], relationship_rows: Iterable[Sequence]
+    ):
+        self.entities.writerows(entity_rows)
+        self.relationships.writerows(relationship_rows)
+
+    def close(self):
+        self.entities.close()
+        self.relationships.close()
+
+    def abort(self):
+        self.entities.abort()
+        self.relationships.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _digest(*parts: str) -> str:
+    return hashlib.blake2b(
+        "\x1f".join(parts).encode("utf-8"), digest_size=8
+    ).hexdigest()
+
+
+def node_id(label: str, keyword: str) -> str:
+    """
+    Stable node id of an entity: a 64 bit digest of its label and keyword.
+    """
+    return _digest(label, keyword)
+
+
+def triplet_rows(triplet) -> Tuple[List, List, List]:
+    """
+    The subject, object and relationship rows of a triplet, in the column order of `Neo4jImportWriter`.
+    """
+    subject_id = node_id(triplet.subject_type, triplet.subject)
+    object_id = node_id(triplet.object_type, triplet.object)
+    relationship_id = _digest(
+        str(triplet.call_id), subject_id, triplet.relation, object_id, triplet.sentence
+    )
+    return (
+        [subject_id, triplet.subject_type, triplet.subject_type, triplet.subject],
+        [object_id, triplet.object_type, triplet.object_type, triplet.object],
+        [
+            relationship_id,
+            triplet.relation,
+            triplet.call_id,
+            triplet.sentence,
+            subject_id,
+            object_id,
+            triplet.context_before,
+            triplet.context_after,
+            triplet.confidence,
+        ],
+    )
+
+
+class DigestSet:
+    """
+    Set of 64 bit digests in an open addressing NumPy table (8 bytes per slot, at most half full), a fraction of
+    the memory of a Python set of strings when deduplicating millions of nodes.
+    """
+
+    def __init__(self, capacity: int = 1 << 16):
+        self._table = np.zeros(max(capacity, 8), dtype=np.uint64)
+        self._mask = len(self._table) - 1
+        if len(self._table) & self._mask:
+            raise ValueError("capacity must be a power of two")
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, digest: int) -> bool:
+        """
+        Adds the digest, returns False when it was already in the set.
+        """
+        digest = np.uint64(digest or 1)  # 0 marks an empty slot
+        slot = int(digest) & self._mask
+        while self._table[slot]:
+            if self._table[slot] == digest:
+                return False
+            slot = (slot + 1) & self._mask
+        self._table[slot] = digest
+        self._size += 1
+        if 2 * self._size > len(self._table):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._table[self._table != 0]
+        self._table = np.zeros(2 * len(self._table), dtype=np.uint64)
+        self._mask = len(self._table) - 1
+        self._size = 0
+        for digest in old:
+            self.add(int(digest))
+
+
+class Neo4jImportWriter:
+    """
+    Streams triplets (anything with the fields of `models.Triplet`) into the CSV files of
+    `neo4j-admin database import full`, as described in neo4j_guideline.md:
+        subjects.csv   source:ID(Subject-ID), :LABEL, label, keyword
+        objects.csv    target:ID(Object-ID), :LABEL, label, keyword
+        rels.csv       id, :TYPE, call_id, sentence, :START_ID(Subject-ID), :END_ID(Object-ID), context_before,
+                       context_after, confidence:float
+    Every node and relationship is written once (deduplicated on its id with a `DigestSet`), so the import needs no
+    --skip-duplicate-nodes.
+    With shards > 1 every file is split into shards (subjects_0.csv, ...), each with its own header.
+    """
+
+    SUBJECT_HEADER = ["source:ID(Subject-ID)", ":LABEL", "label", "keyword"]
+    OBJECT_HEADER = ["target:ID(Object-ID)", ":LABEL", "label", "keyword"]
+    RELATIONSHIP_HEADER = [
+        "id",
+        ":TYPE",
+        "call_id",
+        "sentence",
+        ":START_ID(Subject-ID)",
+        ":END_ID(Object-ID)",
+        "context_before",
+        "context_after",
+        "confidence:float",
+    ]
+
+    def __init__(self, output_dir: str, shards: int = 1, flush_every: int = 10000):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shards = shards
+        self.subjects = self._open("subjects", self.SUBJECT_HEADER, flush_every)
+        self.objects = self._open("objects", self.OBJECT_HEADER, flush_every)
+        self.relationships = self._open("rels", self.RELATIONSHIP_HEADER, flush_every)
+        self._seen_subjects = DigestSet()
+        self._seen_objects = DigestSet()
+        self._seen_relationships = DigestSet()
+
+    def _open(
+        self, name: str, header: List[str], flush_every: int
+    ) -> List[StreamingCSVWriter]:
+        writers = []
+        for shard in range(self.shards):
+            file_name = f"{name}.csv" if self.shards == 1 else f"{name}_{shard}.csv"
+            writer = StreamingCSVWriter(
+                os.path.join(self.output_dir, file_name), flush_every
+            )
+            writer.writerow(header)
+            writers.append(writer)
+        return writers
+
+    def write(self, triplet):
+        subject_row, object_row, relationship_row = triplet_rows(triplet)
+        self._write_unique(self.subjects, self._seen_subjects, subject_row)
+        self._write_unique(self.objects, self._seen_objects, object_row)
+        self._write_unique(
+            self.relationships, self._seen_relationships, relationship_row
+        )
+
+    def write_many(self, triplets: Iterable):
+        for triplet in triplets:
+            self.write(triplet)
+
+    @property
+    def n_relationships(self) -> int:
+        return len(self._seen_relationships)
+
+    def _write_unique(
+        self, writers: List[StreamingCSVWriter], seen: DigestSet, row: List
+    ):
+        digest = int(row[0], 16)
+        if seen.add(digest):
+            writers[digest % self.shards].writerow(row)
+
+    def import_command(self, database: str = "neo4j") -> str:
+        """
+        The `neo4j-admin database import full` call for the written files. It replaces the database, which is
+        what --overwrite-destination allows (see `DeltaGraphLoader` to add to an existing graph instead).
+        """
+        arguments = [
+            f"--{kind}={writer.file_path}"
+            for kind, writers in (
+                ("nodes", self.subjects),
+                ("nodes", self.objects),
+                ("relationships", self.relationships),
+            )
+            for writer in writers
+        ]
+        return (
+            f"neo4j-admin database import full {' '.join(arguments)} "
+            f"--overwrite-destination {database}"
+        )
+
+    def _writers(self) -> List[StreamingCSVWriter]:
+        return self.subjects + self.objects + self.relationships
+
+    def close(self):
+        for writer in self._writers():
+            writer.close()
+        logging.info(
+            f"Wrote {len(self._seen_subjects)} subjects, {len(self._seen_objects)} objects and "
+            f"{self.n_relationships} relationships to {self.output_dir}"
+        )
+
+    def abort(self):
+        for writer in self._writers():
+            writer.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,43 @@
+from collections import namedtuple
+
+import pytest
+
+# the fields of models.Triplet, without importing flair
+Triplet = namedtuple(
+    "Triplet",
+    "call_id subject subject_type relation object object_type confidence sentence context_before context_after",
+)
+
+
+@pytest.fixture
+def make_triplets():
+    """
+    Factory of n triplets, each with its own sentence. Calls, subjects and objects repeat with the given periods,
+    subject types and relations cycle through the given values.
+    """
+
+    def make(
+        n: int,
+        n_calls: int = 1,
+        n_subjects: int = 1,
+        n_objects: int = 1,
+        subject_types=("Person",),
+        relations=("WORKS_AT",),
+    ):
+        return [
+            Triplet(
+                f"call-{i % n_calls}",
+                f"person {i % n_subjects}",
+                subject_types[i % len(subject_types)],
+                relations[i % len(relations)],
+                f"company {i % n_objects}",
+                "Company",
+                0.9,
+                f"sentence {i}",
+                "",
+                "",
+            )
+            for i in range(n)
+        ]
+
+    return make
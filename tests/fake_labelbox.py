@@ -0,0 +1,148 @@
+import uuid
+from labelbox.exceptions import LabelboxError
+from threading import Lock
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+
+class FakeTask:
+    """
+    A finished Labelbox task, with the `status`, `result` and `errors` the real `Task` has after `wait_till_done`.
+    Like the real one, `result` raises a `ValueError` when the task FAILED.
+    """
+
+    def __init__(self, result: List[Dict[str, Any]], errors: List[Dict[str, Any]]):
+        self.uid = str(uuid.uuid4())
+        self.status = "FAILED" if errors and not result else "COMPLETE"
+        self._result = result
+        self.errors = errors or None
+
+    @property
+    def result(self) -> List[Dict[str, Any]]:
+        if self.status == "FAILED":
+            raise ValueError(f"Job failed. Errors : {self.errors}")
+        return self._result
+
+    def wait_till_done(self, timeout_seconds: float = 300.0):
+        pass
+
+
+class FakeDataset:
+    """
+    In-process stand-in for `labelbox.Dataset`. Data rows live in memory and global keys are unique, like on the server.
+    fail_calls makes the first create_data_rows calls raise a `LabelboxError`, fail_tasks makes the next ones return a
+    FAILED task without creating anything, fail_keys makes the given global keys fail once, to exercise the retries.
+    """
+
+    def __init__(
+        self, name: str, fail_calls: int = 0, fail_tasks: int = 0, fail_keys=()
+    ):
+        self.uid = str(uuid.uuid4())
+        self.name = name
+        self.data_rows: Dict[str, SimpleNamespace] = {}
+        self.create_calls = 0
+        self._fail_calls = fail_calls
+        self._fail_tasks = fail_tasks
+        self._fail_keys = set(fail_keys)
+        self._lock = Lock()
+
+    def create_data_rows(self, assets: List[Dict[str, Any]]) -> FakeTask:
+        with self._lock:
+            self.create_calls += 1
+            if self.create_calls <= self._fail_calls:
+                raise LabelboxError("Simulated failure")
+            if self.create_calls <= self._fail_calls + self._fail_tasks:
+                return FakeTask([], [{"message": "Simulated task failure"}])
+
+            result, errors = [], []
+            for asset in assets:
+                global_key = asset.get("global_key")
+                if global_key in self._fail_keys:
+                    self._fail_keys.discard(global_key)
+                    errors.append(
+                        {"message": "Simulated failure", "global_key": global_key}
+                    )
+                    continue
+                if global_key in self.data_rows:
+                    errors.append(
+                        {"message": "Duplicate global key", "global_key": global_key}
+                    )
+                    continue
+                data_row = SimpleNamespace(
+                    uid=str(uuid.uuid4()),
+                    row_data=asset["row_data"],
+                    global_key=global_key,
+                )
+                self.data_rows[global_key] = data_row
+                result.append(
+                    {
+                        "id": data_row.uid,
+                        "global_key": global_key,
+                        "row_data": data_row.row_data,
+                    }
+                )
+            return FakeTask(result, errors)
+
+    def export_data_rows(self):
+        return iter(list(self.data_rows.values()))
+
+
+class FakeLabelboxClient:
+    """
+    In-process stand-in for `labelbox.Client`, for running `DataLabellingService` without a Labelbox account.
+    """
+
+    def __init__(self, fail_imports: int = 0, error_imports: int = 0, **dataset_kwargs):
+        self.datasets: Dict[str, FakeDataset] = {}
+        self.imported_labels: List[Dict[str, Any]] = []
+        self.label_imports: List[FakeLabelImport] = []
+        self.import_calls = 0
+        self.fail_imports = fail_imports
+        self.error_imports = error_imports
+        self.lock = Lock()
+        self._dataset_kwargs = dataset_kwargs
+
+    def create_dataset(self, name: str) -> FakeDataset:
+        dataset = FakeDataset(name, **self._dataset_kwargs)
+        self.datasets[dataset.uid] = dataset
+        return dataset
+
+    def get_ontology(self, ontology_id: str):
+        return SimpleNamespace(uid=ontology_id)
+
+
+class FakeLabelImport:
+    """
+    In-process stand-in for `labelbox.LabelImport`. The imported NDJSON rows end up in `client.imported_labels`.
+    Pass `fail_imports` to the client to make its first label imports raise a `LabelboxError`, and `error_imports` to
+    make the imports after those finish with errors, without importing their labels.
+    """
+
+    def __init__(self, name: str, labels: List[Dict[str, Any]]):
+        self.uid = str(uuid.uuid4())
+        self.name = name
+        self.labels = labels
+        self.errors = []
+
+    @classmethod
+    def create_from_objects(
+        cls,
+        client: "FakeLabelboxClient",
+        project_id: str,
+        name: str,
+        labels: List[Dict[str, Any]],
+    ) -> "FakeLabelImport":
+        with client.lock:
+            client.import_calls += 1
+            if client.import_calls <= client.fail_imports:
+                raise LabelboxError("Simulated failure")
+            job = cls(name, list(labels))
+            if client.import_calls <= client.fail_imports + client.error_imports:
+                job.errors = [{"message": "Simulated import error"}]
+            else:
+                client.imported_labels.extend(job.labels)
+            client.label_imports.append(job)
+        return job
+
+    def wait_until_done(self, sleep_time_seconds: int = 10):
+        pass
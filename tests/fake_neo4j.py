@@ -0,0 +1,95 @@
+import re
+from functools import partial
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+_CREATE_INDEX = re.compile(
+    r"CREATE INDEX IF NOT EXISTS FOR \(n:`((?:[^`]|``)*)`\) ON \(n\.(\w+)\)"
+)
+_MERGE_NODES = re.compile(r"MERGE \(n:`((?:[^`]|``)*)` \{(\w+): row\.id\}\)")
+_MERGE_RELATIONSHIPS = re.compile(
+    r"MATCH \(s:`((?:[^`]|``)*)` \{source: row\.start\}\) "
+    r"MATCH \(o:`((?:[^`]|``)*)` \{target: row\.end\}\) "
+    r"MERGE \(s\)-\[r:`((?:[^`]|``)*)` \{id: row\.id\}\]->\(o\)"
+)
+
+
+class FakeResult:
+    """
+    The result of `FakeBoltSession.run`. The statement is only applied when the result is consumed, and the error of
+    a failing statement only raised then, like with the driver's lazily fetched results.
+    """
+
+    def __init__(self, apply: Callable[[], None]):
+        self._apply = apply
+        self.consumed = False
+
+    def consume(self):
+        if not self.consumed:
+            self.consumed = True
+            self._apply()
+
+
+class FakeBoltSession:
+    """
+    In-process stand-in for a neo4j driver session, for running `DeltaGraphLoader` without a database.
+    Understands only the `CREATE INDEX` and `UNWIND $rows ... MERGE` statements of the loader, and keeps the
+    resulting graph in dicts. fail_statements makes the given statements (counted from 1) fail.
+    """
+
+    def __init__(self, fail_statements=()):
+        self.nodes: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self.relationships: Dict[str, Dict[str, Any]] = {}
+        self.indexes: Set[Tuple[str, str]] = set()
+        self.queries: List[Tuple[str, int]] = []
+        self.results: List[FakeResult] = []
+        self._fail_statements = set(fail_statements)
+
+    def run(
+        self, query: str, parameters: Dict[str, Any] = None, **kwargs
+    ) -> FakeResult:
+        parameters = {**(parameters or {}), **kwargs}
+        self.queries.append((query, len(parameters.get("rows", ()))))
+        if len(self.queries) in self._fail_statements:
+            result = FakeResult(partial(_fail, query))
+        else:
+            result = FakeResult(partial(self._apply, query, parameters))
+        self.results.append(result)
+        return result
+
+    def _apply(self, query: str, parameters: Dict[str, Any]):
+        match = _CREATE_INDEX.search(query)
+        if match:
+            self.indexes.add((match.group(1).replace("``", "`"), match.group(2)))
+            return
+
+        rows = parameters["rows"]
+        match = _MERGE_RELATIONSHIPS.search(query)
+        if match:
+            subject_label, object_label, relation = (
+                name.replace("``", "`") for name in match.groups()
+            )
+            for row in rows:
+                start = (subject_label, "source", row["start"])
+                end = (object_label, "target", row["end"])
+                if start not in self.nodes or end not in self.nodes:
+                    continue  # MATCH finds nothing, so nothing is merged
+                relationship = self.relationships.setdefault(
+                    row["id"], {"type": relation, "start": start, "end": end}
+                )
+                relationship.update(row["properties"])
+            return
+
+        match = _MERGE_NODES.search(query)
+        if match is None:
+            raise ValueError(f"FakeBoltSession does not understand: {query}")
+        label, key = match.group(1).replace("``", "`"), match.group(2)
+        for row in rows:
+            node = self.nodes.setdefault((label, key, row["id"]), {key: row["id"]})
+            node.update(label=row["label"], keyword=row["keyword"])
+
+    def close(self):
+        pass
+
+
+def _fail(query: str):
+    raise RuntimeError(f"Simulated failure of: {query}")
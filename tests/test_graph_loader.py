@@ -0,0 +1,66 @@
+import pytest
+
+from preprocessing.graph_loader import DeltaGraphLoader
+from preprocessing.writers import triplet_rows
+from tests.fake_neo4j import FakeBoltSession
+
+
+@pytest.fixture
+def triplets(make_triplets):
+    return make_triplets(
+        100,
+        n_calls=7,
+        n_subjects=11,
+        n_objects=13,
+        subject_types=("Custom`er", "Person"),
+        relations=("HAS PROBLEM", "WORKS_AT", "WORKS_AT"),
+    )
+
+
+def load(session, index_path, triplets, batch_size=16):
+    with DeltaGraphLoader(session, index_path, batch_size=batch_size) as loader:
+        return loader.load(triplets)
+
+
+def test_load_builds_the_graph_of_the_bulk_import(tmp_path, triplets):
+    session = FakeBoltSession()
+
+    sent = load(session, str(tmp_path / "loaded.sqlite"), triplets)
+
+    relationship_ids = {triplet_rows(triplet)[2][0] for triplet in triplets}
+    assert set(session.relationships) == relationship_ids
+    assert sent["relationship"] == len(relationship_ids)
+    assert all(result.consumed for result in session.results)
+    assert session.indexes == {
+        ("Person", "source"),
+        ("Custom`er", "source"),
+        ("Company", "target"),
+    }
+
+
+def test_load_sends_only_new_and_changed_rows(tmp_path, triplets):
+    session = FakeBoltSession()
+    index_path = str(tmp_path / "loaded.sqlite")
+    load(session, index_path, triplets[:60])
+
+    changed = triplets[10]._replace(confidence=0.5)
+    sent = load(session, index_path, triplets + [changed])
+
+    assert sent == {"subject": 0, "object": 0, "relationship": 40 + 1}
+    assert len(session.relationships) == 100
+    assert session.relationships[triplet_rows(changed)[2][0]]["confidence"] == 0.5
+
+
+def test_load_does_not_mark_rows_of_failed_statements(tmp_path, triplets):
+    index_path = str(tmp_path / "loaded.sqlite")
+    failing = FakeBoltSession(fail_statements={12})
+
+    with pytest.raises(RuntimeError):
+        load(failing, index_path, triplets)
+
+    session = FakeBoltSession()
+    session.nodes, session.relationships = failing.nodes, failing.relationships
+    load(session, index_path, triplets)
+    assert set(session.relationships) == {
+        triplet_rows(triplet)[2][0] for triplet in triplets
+    }
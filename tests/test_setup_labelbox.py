@@ -0,0 +1,161 @@
+import pytest
+from labelbox.exceptions import LabelboxError
+
+from preprocessing.setup_labelbox import DataLabellingService
+from tests.fake_labelbox import FakeLabelboxClient, FakeLabelImport
+
+
+def make_service(tmp_path, **client_kwargs) -> DataLabellingService:
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("entity_mapping:\n  PER: Person\n")
+    service = DataLabellingService(
+        api_key=None,
+        client=FakeLabelboxClient(**client_kwargs),
+        config_path=str(config_path),
+        label_import=FakeLabelImport,
+    )
+    service.create_dataset("test")
+    return service
+
+
+def make_assets(n: int):
+    return [{"row_data": f"text {i}", "global_key": f"key-{i}"} for i in range(n)]
+
+
+def test_create_data_rows_returns_uid_per_global_key(tmp_path):
+    service = make_service(tmp_path)
+    assets = make_assets(25)
+
+    uids = service.create_data_rows(assets, chunk_size=10, backoff=0)
+
+    assert list(uids) == [asset["global_key"] for asset in assets]
+    assert uids == {
+        key: data_row.uid for key, data_row in service.dataset.data_rows.items()
+    }
+
+
+@pytest.mark.parametrize("failure", [{"fail_calls": 2}, {"fail_tasks": 2}])
+def test_create_data_rows_retries_failed_chunks(tmp_path, failure):
+    service = make_service(tmp_path, **failure)
+    assets = make_assets(25)
+
+    uids = service.create_data_rows(assets, chunk_size=10, max_workers=1, backoff=0)
+
+    assert len(uids) == 25
+    assert len(service.dataset.data_rows) == 25
+    assert service.dataset.create_calls == 3 + 2
+
+
+def test_create_data_rows_retries_only_failed_assets(tmp_path):
+    service = make_service(tmp_path, fail_keys={"key-3", "key-7"})
+    assets = make_assets(10)
+
+    uids = service.create_data_rows(assets, chunk_size=10, backoff=0)
+
+    assert len(uids) == 10
+    assert service.dataset.create_calls == 2
+
+
+def test_create_data_rows_leaves_out_assets_that_keep_failing(tmp_path):
+    service = make_service(tmp_path, fail_tasks=100)
+    assets = make_assets(25)
+
+    uids = service.create_data_rows(
+        assets, chunk_size=10, max_retries=2, max_workers=1, backoff=0
+    )
+
+    assert uids == {}
+    assert service.dataset.create_calls == 3 * 3
+
+
+def make_labels(service: DataLabellingService, data_rows):
+    return [
+        service.gather_labels(
+            service.create_span_annotations([(0, 4, "PER"), (10, 14, "PER")]), uid
+        )
+        for uid in data_rows
+    ]
+
+
+class InterruptedLabelImport(FakeLabelImport):
+    """
+    Loses the connection from the third label import on.
+    """
+
+    @classmethod
+    def create_from_objects(cls, client, project_id, name, labels):
+        if client.import_calls >= 2:
+            raise LabelboxError("Connection lost")
+        return super().create_from_objects(client, project_id, name, labels)
+
+
+def test_upload_labels_resumes_after_interruption(tmp_path):
+    service = make_service(tmp_path)
+    labels = make_labels(service, [f"row-{i}" for i in range(20)])
+    progress_file = str(tmp_path / "progress.txt")
+
+    service.label_import = InterruptedLabelImport
+    with pytest.raises(LabelboxError):
+        service.upload_labels(
+            labels,
+            max_chunk_bytes=500,
+            max_in_flight=1,
+            max_retries=0,
+            progress_file=progress_file,
+        )
+    first_run = len(service.client.imported_labels)
+    assert 0 < first_run < 40
+
+    service.label_import = FakeLabelImport
+    service.upload_labels(
+        labels, max_chunk_bytes=500, max_in_flight=2, progress_file=progress_file
+    )
+
+    imported = service.client.imported_labels
+    assert len(imported) == 40
+    assert sorted(row["dataRow"]["id"] for row in imported) == sorted(
+        f"row-{i}" for i in range(20) for _ in range(2)
+    )
+
+
+def test_upload_labels_does_not_acknowledge_chunks_with_errors(tmp_path):
+    service = make_service(tmp_path, error_imports=1)
+    labels = make_labels(service, [f"row-{i}" for i in range(20)])
+    progress_file = str(tmp_path / "progress.txt")
+
+    service.upload_labels(labels, max_chunk_bytes=500, progress_file=progress_file)
+    assert len(service.client.imported_labels) < 40
+    n_calls = service.client.import_calls
+
+    service.upload_labels(labels, max_chunk_bytes=500, progress_file=progress_file)
+    assert len(service.client.imported_labels) == 40
+    assert service.client.import_calls == n_calls + 1
+
+
+def test_upload_labels_progress_file_does_not_skip_other_labels(tmp_path):
+    service = make_service(tmp_path)
+    progress_file = str(tmp_path / "progress.txt")
+    service.upload_labels(
+        make_labels(service, [f"row-{i}" for i in range(20)]),
+        max_chunk_bytes=500,
+        progress_file=progress_file,
+    )
+
+    service.upload_labels(
+        make_labels(service, [f"other-{i}" for i in range(20)]),
+        max_chunk_bytes=500,
+        progress_file=progress_file,
+    )
+
+    assert len(service.client.imported_labels) == 80
+
+
+def test_upload_labels_streams_a_generator(tmp_path):
+    service = make_service(tmp_path)
+
+    service.upload_labels(
+        iter(make_labels(service, [f"row-{i}" for i in range(20)])),
+        max_chunk_bytes=500,
+    )
+
+    assert len(service.client.imported_labels) == 40
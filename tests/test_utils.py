@@ -0,0 +1,62 @@
+import json
+import random
+
+import pytest
+
+from preprocessing.utils import iter_json
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(7 if depth < 2 else 5)
+    if kind == 0:
+        return rng.randint(-(10**6), 10**6)
+    if kind == 1:
+        return rng.choice([rng.uniform(-1e3, 1e3), 1.5, 1e-7, -2.5e20])
+    if kind == 2:
+        return "".join(rng.choice('ab ,]"\\é\n') for _ in range(rng.randrange(6)))
+    if kind == 3:
+        return rng.choice([True, False])
+    if kind == 4:
+        return None
+    if kind == 5:
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+    return {f"k{i}": random_value(rng, depth + 1) for i in range(rng.randrange(4))}
+
+
+def random_arrays(n: int):
+    rng = random.Random(0)
+    return [[random_value(rng) for _ in range(rng.randrange(1, 8))] for _ in range(n)]
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8])
+def test_iter_json_reads_arrays_like_json_load(tmp_path, chunk_size, indent):
+    path = tmp_path / "export.json"
+    for items in random_arrays(50):
+        path.write_text(json.dumps(items, indent=indent), encoding="utf-8")
+        with open(path, encoding="utf-8") as f:
+            expected = json.load(f)
+
+        assert list(iter_json(str(path), chunk_size=chunk_size)) == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8])
+def test_iter_json_reads_ndjson_like_json_load(tmp_path, chunk_size):
+    path = tmp_path / "export.ndjson"
+    for items in random_arrays(50):
+        # a file starting with an array is read as a JSON array, so no NDJSON line is one
+        items = [{"items": item} if isinstance(item, list) else item for item in items]
+        path.write_text(
+            "\n".join(json.dumps(item) for item in items) + "\n", encoding="utf-8"
+        )
+
+        assert list(iter_json(str(path), chunk_size=chunk_size)) == [
+            json.loads(json.dumps(item)) for item in items
+        ]
+
+
+def test_iter_json_splits_a_float_across_reads(tmp_path):
+    path = tmp_path / "export.json"
+    path.write_text("[1.5, 2]")
+
+    assert list(iter_json(str(path), chunk_size=3)) == [1.5, 2]
@@ -0,0 +1,40 @@
+import csv
+
+import pytest
+
+from preprocessing.writers import Neo4jImportWriter
+
+
+def read_rows(paths):
+    rows = []
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            rows.extend(list(csv.reader(f))[1:])
+    return rows
+
+
+@pytest.mark.parametrize("shards", [1, 3])
+def test_writes_every_node_and_relationship_once(tmp_path, make_triplets, shards):
+    triplets = make_triplets(20, n_calls=5, n_subjects=3, n_objects=2)
+    with Neo4jImportWriter(str(tmp_path), shards=shards) as writer:
+        writer.write_many(triplets)
+        writer.write_many(triplets[:7])
+
+    subjects = read_rows(w.file_path for w in writer.subjects)
+    objects = read_rows(w.file_path for w in writer.objects)
+    relationships = read_rows(w.file_path for w in writer.relationships)
+    assert len(subjects) == 3
+    assert len(objects) == 2
+    assert len(relationships) == writer.n_relationships == 20
+    assert len({row[0] for row in relationships}) == 20
+
+
+def test_import_command_overwrites_the_database(tmp_path, make_triplets):
+    with Neo4jImportWriter(str(tmp_path)) as writer:
+        writer.write_many(make_triplets(4))
+
+    command = writer.import_command("graph")
+    assert command.startswith("neo4j-admin database import full ")
+    assert command.endswith(" --overwrite-destination graph")
+    for file_writer in writer.subjects + writer.objects + writer.relationships:
+        assert file_writer.file_path in command
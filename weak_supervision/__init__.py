@@ -1,3 +1,3 @@
-from .train_word2vec import Word2VecWrapper
+from .train_word2vec import StreamingCorpus, Word2VecWrapper
 
-__all__ = ["Word2VecWrapper"]
+__all__ = ["StreamingCorpus", "Word2VecWrapper"]
@@ -7,10 +7,7 @@ python -c "
 from train_word2vec import Word2VecWrapper
 
 model_creator = Word2VecWrapper('$DATA_FILE_PATH', '$CONFIG_PATH')
-model_creator.load_data()
-model_creator.clean_data()
-model_creator.lemmatize_and_remove_stopwords()
-model_creator.create_bigrams()
+model_creator.prepare_corpus()
 model_creator.train_word2vec_model()
 "
 
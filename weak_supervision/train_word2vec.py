@@ -5,16 +5,168 @@ import re
 import itertools
 import string
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import configparser
 import itertools
 import logging
+import hashlib
+import json
+import os
 from gensim.models import Word2Vec
 from gensim.models.phrases import Phrases, Phraser
 from string import punctuation
 from time import time
+from typing import Iterable, Iterator, List, Tuple
 
 logging.basicConfig(filename="trainw2vec.log", encoding="utf-8", level=logging.DEBUG)
 
+_BRACKETED = re.compile(r"[\(\[].*?[\)\]]")
+_ELLIPSIS = re.compile(r"\.\.\.")
+_SENTENCE_END = re.compile(r"(?<=\w[?\.])\s")
+_PUNCTUATION_TABLE = str.maketrans("", "", string.punctuation)
+
+
+def _clean_chunk(texts: pd.Series) -> pd.Series:
+    """
+    The cleaning steps of `Word2VecWrapper.clean_data` for one chunk of conversations.
+    """
+    texts = (
+        texts.astype(str)
+        .str.replace(_BRACKETED, "", regex=True)
+        .str.replace(_ELLIPSIS, "", regex=True)
+    )
+    sentences = texts.str.split(_SENTENCE_END).explode().str.strip()
+    # same as Word2VecWrapper.remove_short: at least 5 space separated pieces
+    sentences = sentences[sentences.str.count(" ") >= 4]
+    return sentences.str.translate(_PUNCTUATION_TABLE).str.lower()
+
+
+class StreamingCorpus:
+    """
+    Restartable iterable over a text file with one whitespace tokenised sentence per line.
+    Every pass reopens the file, so gensim can scan it for the vocabulary and again for every epoch without the corpus
+    ever being held in memory. If a phraser is given, it is applied to every sentence on the fly.
+    """
+
+    def __init__(self, path: str, phraser=None):
+        self.path = path
+        self.phraser = phraser
+
+    def __iter__(self) -> Iterator[List[str]]:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                tokens = line.split()
+                if self.phraser is not None:
+                    tokens = self.phraser[tokens]
+                yield tokens
+
+
+def write_sentences(sentences: Iterable[str], path: str) -> int:
+    """
+    Writes one sentence per line, whitespace (including newlines inside a sentence) collapsed to single spaces,
+    which leaves the tokens `str.split` sees untouched. Returns the number of lines written.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        return _append_sentences(sentences, f)
+
+
+def _append_sentences(sentences: Iterable[str], f) -> int:
+    n_lines = 0
+    for sentence in sentences:
+        f.write(" ".join(str(sentence).split()) + "\n")
+        n_lines += 1
+    return n_lines
+
+
+def _write_stage(sentences: Iterable[str], path: str):
+    """
+    Writes a cache file through a temporary file, so an interrupted run never leaves a truncated stage behind.
+    """
+    try:
+        n_lines = write_sentences(sentences, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    finally:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+    logging.info(f"Cached {n_lines} sentences in {path}")
+
+
+def _file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+_W2V_PARAMS = {
+    "min_count": 20,
+    "sample": 6e-5,
+    "alpha": 0.03,
+    "min_alpha": 0.0007,
+    "negative": 20,
+}
+
+
+def _train_grid_point(
+    vocabulary: dict,
+    corpus: dict,
+    epochs: int,
+    window_size: int,
+    vector_size: int,
+    workers: int,
+    model_filename: str,
+):
+    logging.info(
+        f"Training model with epochs={epochs}, window_size={window_size}, vector_size={vector_size}"
+    )
+    model = Word2Vec(
+        window=window_size, vector_size=vector_size, workers=workers, **_W2V_PARAMS
+    )
+    model.build_vocab_from_freq(
+        vocabulary["word_freq"], corpus_count=vocabulary["corpus_count"]
+    )
+    model.corpus_total_words = vocabulary["corpus_total_words"]
+
+    t = time()
+    model.train(
+        **corpus,
+        total_examples=model.corpus_count,
+        total_words=model.corpus_total_words,
+        epochs=epochs,
+        report_delay=1,
+    )
+    seconds = time() - t
+
+    model.save(model_filename)
+    return model, seconds
+
+
+def _train_grid_point_in_worker(*args) -> float:
+    _, seconds = _train_grid_point(*args)
+    return seconds
+
+
+def _log_grid_point(model_filename: str, seconds: float):
+    logging.info("Time to train the model: {} mins".format(round(seconds / 60, 2)))
+    logging.info(f"Model saved as {model_filename}")
+
+
+def _read_grid_progress(progress_file: str, corpus_id: str) -> set:
+    finished = set()
+    if os.path.exists(progress_file):
+        with open(progress_file, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if record["corpus"] == corpus_id:
+                    finished.add(record["model"])
+    return finished
+
+
+def _record_grid_progress(progress_file: str, corpus_id: str, model_filename: str):
+    with open(progress_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"corpus": corpus_id, "model": model_filename}) + "\n")
+
 
 class Word2VecWrapper:
     def __init__(self, file_path: str, config_path: str):
@@ -23,6 +175,11 @@ class Word2VecWrapper:
         self.df = None
         self.nlp = spacy.load("nl_core_news_md", disable=["ner", "parser"])
         self.model = None
+        self.corpus_path = None
+        self.corpus_file = None
+        self.cache_dir = self.config.get("Word2Vec", "cache_dir", fallback="w2v_cache")
+        self._input_hash = None
+        self.vocabulary = None
 
     @staticmethod
     def read_config(config_path):
@@ -30,38 +187,52 @@ class Word2VecWrapper:
         config.read(config_path)
         return config
 
-    def load_data(self):
+    def load_data(self, chunksize: int = None):
+        """
+        Reads the gzipped transcripts into self.df. With chunksize, returns an iterator over DataFrames of chunksize
+        conversations instead, read lazily from the gzip stream.
+        """
+        if chunksize is not None:
+            return pd.read_csv(
+                self.file_path,
+                compression="gzip",
+                delimiter=",",
+                header=None,
+                names=["CONTACT_TEXT"],
+                chunksize=chunksize,
+            )
         self.df = pd.read_csv(
             self.file_path, compression="gzip", delimiter=",", header=None
         )
         self.df.columns = ["CONTACT_TEXT"]
 
-    def clean_data(self):
+    def clean_data(self, n_process: int = 1, chunk_size: int = 100000):
+        """
+        Strips bracketed asides and ellipses, splits the conversations into sentences, drops sentences shorter than
+        5 words and lowercases them without punctuation. Runs vectorised over chunks of chunk_size conversations,
+        spread over n_process processes.
+        """
         t = time()
-        cleaned_texts = [
-            re.sub("[\(\[].*?[\)\]]", "", str(conversation))
-            for conversation in self.df["CONTACT_TEXT"].values
-        ]
-        cleaned_texts = [re.sub("\.\.\.", "", str(sent)) for sent in cleaned_texts]
-        cleaned_texts = [
-            re.split(r"(?<=\w[?\.])\s", str(call)) for call in cleaned_texts
+        texts = self.df["CONTACT_TEXT"]
+        chunks = [
+            texts.iloc[i : i + chunk_size] for i in range(0, len(texts), chunk_size)
         ]
-        cleaned_texts = list(itertools.chain(*cleaned_texts))
-        cleaned_texts = [call.strip() for call in cleaned_texts]
 
-        self.df = pd.DataFrame({"clean": cleaned_texts})
-        self.df["Pass"] = self.df.progress_apply(
-            lambda x: self.remove_short(x.clean), axis=1
-        )
-        self.df = (
-            self.df[self.df["Pass"] != False]
-            .drop("Pass", axis=1)
-            .reset_index(drop=True)
-        )
-        self.df["clean"] = self.df["clean"].progress_apply(
-            lambda x: "".join([i.lower() for i in x if i not in string.punctuation])
+        if n_process > 1:
+            with ProcessPoolExecutor(max_workers=n_process) as executor:
+                cleaned = list(executor.map(_clean_chunk, chunks))
+        else:
+            cleaned = [_clean_chunk(chunk) for chunk in chunks]
+
+        self.df = pd.DataFrame(
+            {"clean": pd.concat(cleaned, ignore_index=True) if cleaned else []}
         )
 
+        elapsed = max(time() - t, 1e-9)
+        logging.info(
+            f"Cleaned {len(texts)} conversations into {len(self.df)} sentences "
+            f"({len(texts) / elapsed:.1f} conversations/s, {len(self.df) / elapsed:.1f} sentences/s)"
+        )
         logging.debug(
             "Time to clean up everything: {} mins".format(round((time() - t) / 60, 2))
         )
@@ -72,20 +243,243 @@ class Word2VecWrapper:
         if len(sentences) < 5:
             return False
 
-    def lemmatize_and_remove_stopwords(self):
-        self.df["clean"] = self.df.clean.progress_apply(
-            lambda text: " ".join(
-                token.text for token in self.nlp(text) if not token.is_stop
+    def lemmatize_and_remove_stopwords(
+        self, batch_size: int = 1000, n_process: int = 1
+    ):
+        """
+        `is_stop` is a lexical attribute, so only the tokenizer is needed. In a single process the texts go straight
+        through `nlp.tokenizer.pipe`, with n_process > 1 through `nlp.pipe` with every pipeline component disabled.
+        """
+        t = time()
+        cleaned, n_tokens = [], 0
+        for sentence, sentence_tokens in self._remove_stopwords(
+            self.df["clean"], batch_size, n_process
+        ):
+            cleaned.append(sentence)
+            n_tokens += sentence_tokens
+        self.df["clean"] = cleaned
+
+        elapsed = max(time() - t, 1e-9)
+        logging.info(
+            f"Removed stop words from {len(cleaned)} sentences in {round(elapsed / 60, 2)} mins "
+            f"({len(cleaned) / elapsed:.1f} sentences/s, {n_tokens / elapsed:.1f} tokens/s, "
+            f"batch_size={batch_size}, n_process={n_process})"
+        )
+
+    def _remove_stopwords(
+        self, texts: Iterable[str], batch_size: int, n_process: int
+    ) -> Iterator[Tuple[str, int]]:
+        """
+        Yields every text without its stop words, with its number of tokens.
+        """
+        with self.nlp.select_pipes(disable=self.nlp.pipe_names):
+            if n_process > 1:
+                docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+            else:
+                docs = self.nlp.tokenizer.pipe(texts, batch_size=batch_size)
+            for doc in docs:
+                kept = [token.text for token in doc if not token.is_stop]
+                yield " ".join(kept), len(doc)
+
+    def stream_corpus(
+        self,
+        clean_path: str,
+        nostop_path: str,
+        chunksize: int = 100000,
+        n_process: int = 1,
+        batch_size: int = 1000,
+    ) -> int:
+        """
+        Chunked load_data + clean_data + lemmatize_and_remove_stopwords. Every chunk of chunksize conversations is
+        cleaned and appended to the cleaned corpus file, and the cleaned sentences of all chunks go through a single
+        stop word pipe into the stop word free corpus file, so memory stays bounded by the chunk size whatever the size
+        of the input. Returns the number of sentences written.
+        """
+        t = time()
+        n_conversations = n_sentences = n_tokens = 0
+        try:
+            with open(clean_path + ".tmp", "w", encoding="utf-8") as clean_file, open(
+                nostop_path + ".tmp", "w", encoding="utf-8"
+            ) as nostop_file:
+
+                def cleaned_sentences() -> Iterator[str]:
+                    nonlocal n_conversations
+                    for chunk in self.load_data(chunksize=chunksize):
+                        clean = _clean_chunk(chunk["CONTACT_TEXT"])
+                        _append_sentences(clean, clean_file)
+                        n_conversations += len(chunk)
+                        logging.debug(f"Cleaned {n_conversations} conversations")
+                        yield from clean
+
+                # One pipe over all the chunks, so with n_process > 1 the worker processes are started only once.
+                for sentence, sentence_tokens in self._remove_stopwords(
+                    cleaned_sentences(), batch_size, n_process
+                ):
+                    n_sentences += _append_sentences([sentence], nostop_file)
+                    n_tokens += sentence_tokens
+            os.replace(clean_path + ".tmp", clean_path)
+            os.replace(nostop_path + ".tmp", nostop_path)
+        finally:
+            for path in (clean_path + ".tmp", nostop_path + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        elapsed = max(time() - t, 1e-9)
+        logging.info(
+            f"Streamed {n_conversations} conversations into {n_sentences} sentences in {round(elapsed / 60, 2)} mins "
+            f"({n_conversations / elapsed:.1f} conversations/s, {n_tokens / elapsed:.1f} tokens/s, chunksize={chunksize})"
+        )
+        return n_sentences
+
+    def write_corpus(self, corpus_path: str = None):
+        """
+        Writes the cleaned sentences to disk, one per line, for `create_bigrams` and the training to stream from.
+        """
+        if corpus_path is None:
+            corpus_path = self.config.get(
+                "Word2Vec", "corpus_path", fallback="w2v_corpus.txt"
             )
+        n_lines = write_sentences(self.df["clean"], corpus_path)
+        self.corpus_path = corpus_path
+        logging.info(f"Wrote {n_lines} sentences to {corpus_path}")
+
+    def create_bigrams(self, corpus_path: str = None):
+        """
+        Learns the bigrams over the whole on-disk corpus and streams the phrased sentences from it, instead of
+        keeping the (first million) sentences in memory. Writes the corpus first if that has not happened yet.
+        """
+        if corpus_path is None:
+            if self.corpus_path is None:
+                self.write_corpus()
+            corpus_path = self.corpus_path
+
+        phrases = Phrases(
+            StreamingCorpus(corpus_path), min_count=30, progress_per=10000
         )
+        self.bigram = Phraser(phrases)
+        self.sentences = StreamingCorpus(corpus_path, phraser=self.bigram)
+
+    def prepare_corpus(self, n_process: int = 1, chunksize: int = None) -> str:
+        """
+        Runs load/clean, stop word removal and bigram phrasing, persisting the output of every stage as a plain
+        one-sentence-per-line file in cache_dir. A stage is skipped when its file already exists for the same input
+        file and settings. The final (phrased) file is used for training in gensim's corpus_file mode.
+        With chunksize, the first two stages are streamed chunk by chunk (see `stream_corpus`).
+        """
+        clean = {"stage": "clean", "version": 1}
+        nostop = {
+            "stage": "nostop",
+            "parent": clean,
+            "model": f"{self.nlp.lang}_{self.nlp.meta.get('name')}-{self.nlp.meta.get('version')}",
+        }
+        phrased = {"stage": "phrased", "parent": nostop, "min_count": 30}
+        clean_path = self._stage_path(clean)
+        nostop_path = self._stage_path(nostop)
+        if chunksize is not None and not (
+            os.path.exists(clean_path) and os.path.exists(nostop_path)
+        ):
+            self.stream_corpus(
+                clean_path, nostop_path, chunksize=chunksize, n_process=n_process
+            )
 
-    def create_bigrams(self):
-        sent = [row.split() for row in self.df["clean"][:1000000]]
-        phrases = Phrases(sent, min_count=30, progress_per=10000)
-        bigram = Phraser(phrases)
-        self.sentences = bigram[sent]
+        if os.path.exists(clean_path):
+            logging.info(f"Using cached cleaned corpus {clean_path}")
+        else:
+            self.load_data()
+            self.clean_data(n_process=n_process)
+            _write_stage(self.df["clean"], clean_path)
 
-    def train_word2vec_model(self):
+        if os.path.exists(nostop_path):
+            logging.info(f"Using cached stop word free corpus {nostop_path}")
+        else:
+            if self.df is None or "clean" not in self.df:
+                with open(clean_path, encoding="utf-8") as f:
+                    self.df = pd.DataFrame({"clean": [line.rstrip("\n") for line in f]})
+            self.lemmatize_and_remove_stopwords(n_process=n_process)
+            _write_stage(self.df["clean"], nostop_path)
+        self.df = None  # everything downstream streams from disk
+        self.corpus_path = nostop_path
+
+        phrased_path = self._stage_path(phrased)
+        if os.path.exists(phrased_path):
+            logging.info(f"Using cached phrased corpus {phrased_path}")
+        else:
+            self.create_bigrams(nostop_path)
+            _write_stage((" ".join(tokens) for tokens in self.sentences), phrased_path)
+
+        self.corpus_file = phrased_path
+        self.sentences = StreamingCorpus(phrased_path)
+        return phrased_path
+
+    def _stage_path(self, settings: dict) -> str:
+        """
+        The key of a stage only covers the content of the input file and the settings of the stage and the stages
+        before it, not any path, so the cache survives moving or renaming the input file or cache_dir.
+        """
+        if self._input_hash is None:
+            self._input_hash = _file_hash(self.file_path)
+        key = hashlib.sha256(
+            json.dumps({"input": self._input_hash, **settings}, sort_keys=True).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, f"{settings['stage']}_{key[:16]}.txt")
+
+    def build_vocabulary(self) -> dict:
+        """
+        Scans the corpus once for the vocabulary, which does not depend on window, vector size or epochs, and shares it
+        between all grid points. With a cached corpus file (see `prepare_corpus`) the vocabulary is persisted next to it.
+        Only the retained words are kept, in first-seen order, so every model sorts them exactly like `build_vocab` would.
+        """
+        vocab_path = None
+        if self.corpus_file is not None:
+            vocab_path = f"{self.corpus_file}.vocab_mc{_W2V_PARAMS['min_count']}.json"
+            if os.path.exists(vocab_path):
+                with open(vocab_path, encoding="utf-8") as f:
+                    self.vocabulary = json.load(f)
+                logging.info(f"Loaded vocabulary from {vocab_path}")
+                return self.vocabulary
+
+        t = time()
+        model = Word2Vec(**_W2V_PARAMS)
+        model.build_vocab(**self._corpus(), progress_per=10000, keep_raw_vocab=True)
+        self.vocabulary = {
+            "corpus_count": model.corpus_count,
+            "corpus_total_words": model.corpus_total_words,
+            "word_freq": {
+                word: int(count)
+                for word, count in model.raw_vocab.items()
+                if count >= model.min_count
+            },
+        }
+        logging.info("Time to build vocab: {} mins".format(round((time() - t) / 60, 2)))
+
+        if vocab_path is not None:
+            with open(vocab_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.vocabulary, f)
+            os.replace(vocab_path + ".tmp", vocab_path)
+        return self.vocabulary
+
+    def _corpus(self) -> dict:
+        # corpus_file mode (set up by prepare_corpus) scales across the worker threads, an iterable does not
+        if self.corpus_file is not None:
+            return {"corpus_file": self.corpus_file}
+        return {"corpus_iterable": self.sentences}
+
+    def train_word2vec_model(
+        self,
+        parallel_models: int = 1,
+        total_workers: int = None,
+        progress_file: str = "w2v_grid_progress.jsonl",
+    ):
+        """
+        Trains a model for every (epochs, window size, vector size) combination in the config on the shared vocabulary.
+        parallel_models grid points run at the same time in separate processes, each with total_workers // parallel_models
+        worker threads. Finished grid points are recorded in progress_file, keyed by a hash of the corpus content, and
+        skipped when the grid is run again on the same corpus. Afterwards self.model is the model of the last grid point
+        (also when it was trained in another process or in an earlier run).
+        """
         epochs_list = [int(e) for e in self.config["Word2Vec"]["epochs"].split(",")]
         window_sizes = [
             int(w) for w in self.config["Word2Vec"]["window_sizes"].split(",")
@@ -94,41 +488,76 @@ class Word2VecWrapper:
             int(v) for v in self.config["Word2Vec"]["vector_sizes"].split(",")
         ]
 
+        if total_workers is None:
+            total_workers = max(1, multiprocessing.cpu_count() - 1)
+        workers = max(1, total_workers // parallel_models)
+
+        vocabulary = self.build_vocabulary()
+        corpus = self._corpus()
+        corpus_id = self._corpus_id()
+        finished = _read_grid_progress(progress_file, corpus_id) if corpus_id else set()
+
+        grid = []
         for epochs, window_size, vector_size in itertools.product(
             epochs_list, window_sizes, vector_sizes
         ):
-            logging.info(
-                f"Training model with epochs={epochs}, window_size={window_size}, vector_size={vector_size}"
-            )
-            cores = multiprocessing.cpu_count()
-            self.model = Word2Vec(
-                min_count=20,
-                window=window_size,
-                vector_size=vector_size,
-                sample=6e-5,
-                alpha=0.03,
-                min_alpha=0.0007,
-                negative=20,
-                workers=cores - 1,
-            )
+            model_filename = f"w2v_model_e{epochs}_w{window_size}_v{vector_size}.model"
+            last_model_filename = model_filename
+            if model_filename in finished and os.path.exists(model_filename):
+                logging.info(f"Skipping {model_filename}, already trained")
+                continue
+            grid.append((epochs, window_size, vector_size, model_filename))
+        logging.info(
+            f"Training {len(grid)} grid points, {parallel_models} at a time with {workers} workers each"
+        )
 
-            t = time()
-            self.model.build_vocab(self.sentences, progress_per=10000)
-            logging.info(
-                "Time to build vocab: {} mins".format(round((time() - t) / 60, 2))
-            )
+        if parallel_models > 1:
+            with ProcessPoolExecutor(max_workers=parallel_models) as executor:
+                futures = {
+                    executor.submit(
+                        _train_grid_point_in_worker,
+                        vocabulary,
+                        corpus,
+                        epochs,
+                        window_size,
+                        vector_size,
+                        workers,
+                        model_filename,
+                    ): model_filename
+                    for epochs, window_size, vector_size, model_filename in grid
+                }
+                for future in as_completed(futures):
+                    _log_grid_point(futures[future], future.result())
+                    if corpus_id:
+                        _record_grid_progress(progress_file, corpus_id, futures[future])
+            self.model = Word2Vec.load(last_model_filename)
+        else:
+            for epochs, window_size, vector_size, model_filename in grid:
+                self.model, seconds = _train_grid_point(
+                    vocabulary,
+                    corpus,
+                    epochs,
+                    window_size,
+                    vector_size,
+                    workers,
+                    model_filename,
+                )
+                _log_grid_point(model_filename, seconds)
+                if corpus_id:
+                    _record_grid_progress(progress_file, corpus_id, model_filename)
+            if not grid:
+                self.model = Word2Vec.load(last_model_filename)
 
-            t = time()
-            self.model.train(
-                self.sentences,
-                total_examples=self.model.corpus_count,
-                epochs=epochs,
-                report_delay=1,
-            )
-            logging.info(
-                "Time to train the model: {} mins".format(round((time() - t) / 60, 2))
-            )
-
-            model_filename = f"w2v_model_e{epochs}_w{window_size}_v{vector_size}.model"
-            self.model.save(model_filename)
-            logging.info(f"Model saved as {model_filename}")
+    def _corpus_id(self):
+        """
+        Hash of the corpus the models are trained on, None when the corpus is not a file (nothing can be resumed then).
+        """
+        if self.corpus_file is not None:
+            return _file_hash(self.corpus_file)
+        if isinstance(getattr(self, "sentences", None), StreamingCorpus):
+            phrased = "phrased" if self.sentences.phraser is not None else "plain"
+            return f"{_file_hash(self.sentences.path)}-{phrased}"
+        logging.warning(
+            "The corpus is not a file, finished grid points are not recorded"
+        )
+        return None